@@ -0,0 +1,4 @@
+"""
+Benchmarks for the totalnum db build and dashboard on synthetic ACT-like data.
+synth generates the data and bench times it; see bench.py for usage.
+"""
@@ -0,0 +1,260 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+from os import listdir
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import totalnum_builddb_v2 as builder
+import totalnum_cube
+from benchmark import synth
+
+"""
+Times totalnum_builddb_v2 stage by stage, then each dashboard callback and each SQL statement it issues,
+on synthetic data (see synth.py). Results are saved as JSON so runs can be compared:
+
+  python -m benchmark.bench --datadir /tmp/bench --paths 100000 --sites 20 --refreshes 5 --out before.json
+  (make a change)
+  python -m benchmark.bench --datadir /tmp/bench --out after.json
+  python -m benchmark.bench --compare before.json after.json
+
+The data in datadir is generated on the first run and reused after that (unless --regenerate), so runs are comparable.
+Peak memory is the process's peak RSS during each stage (and the largest worker process's, for --jobs>1).
+"""
+
+# Reset the peak RSS of this process, if the OS allows it (Linux)
+def peakReset():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+# Peak RSS of this process and its largest child, in MB
+def peakRss():
+    peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'): peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is KB on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    if peak is None: peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    return peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+
+# Run fn as a named stage, recording its wall time and peak memory in stages
+def stage(stages, name, fn, *args, **kwargs):
+    print("=== %s" % name)
+    peakReset()
+    start = time.time()
+    ret = fn(*args, **kwargs)
+    wall = time.time() - start
+    peak, children = peakRss()
+    stages.append({'stage': name, 'wall': wall, 'peak_rss_mb': round(peak, 1), 'peak_children_mb': round(children, 1)})
+    print("=== %s: %.2f sec, peak %.0f MB" % (name, wall, peak))
+    return ret
+
+""" Full build, post-processing and cube, then an incremental build with nothing to do and one with a new report. """
+def benchBuild(stages, ontfile, reportdir, jobs=1):
+    dbfile = reportdir + '/totalnums.db'
+    if os.path.exists(dbfile): os.remove(dbfile)
+    builder.basedir = reportdir
+    builder.bigfullnamefile = ontfile
+    builder.conn = None
+    builder.openDb(dbfile)
+
+    stage(stages, 'buildDb', builder.buildDb, jobs=jobs)
+    stage(stages, 'postProcessRecent', builder.postProcessRecent)
+    stage(stages, 'postProcessViews', builder.postProcessViews)
+    stage(stages, 'postProcessDenominators', builder.postProcessDenominators)
+    stage(stages, 'postProcessOutliers', builder.postProcessOutliers)
+    stage(stages, 'postProcessMissing', builder.postProcessMissing)
+    stage(stages, 'postProcessTrends', builder.postProcessTrends)
+    stage(stages, 'postProcessRollup', builder.postProcessRollup)
+    stage(stages, 'postProcessHierarchy', builder.postProcessHierarchy)
+    stage(stages, 'analyzeDb', builder.analyzeDb)
+    stage(stages, 'writeCube', totalnum_cube.writeCube, builder.conn, reportdir + '/totalnums_cube')
+
+    changed = stage(stages, 'buildDb incremental (no changes)', builder.buildDb, incremental=True, jobs=jobs)
+    stage(stages, 'postProcess incremental (no changes)', builder.postProcess, changed)
+
+    # A new refresh for one site, 90 days after its last one. It is removed afterward so the data stays as generated.
+    reports = sorted(f for f in listdir(reportdir) if f.endswith('.csv'))
+    newfile = reportdir + '/' + reports[-1].rsplit('_', 1)[0] + '_bench.csv'
+    df = pd.read_csv(reportdir + '/' + reports[-1])
+    df['AGG_DATE'] = (pd.to_datetime(df['AGG_DATE']) + pd.Timedelta(days=90)).dt.strftime('%Y-%m-%d')
+    df.to_csv(newfile, index=False)
+    try:
+        changed = stage(stages, 'buildDb incremental (1 new report)', builder.buildDb, incremental=True, jobs=jobs)
+        stage(stages, 'postProcess incremental (1 new report)', builder.postProcess, changed)
+    finally:
+        os.remove(newfile)
+    builder.conn.close()
+    builder.conn = None
+    stages.append({'stage': 'db size', 'mb': round(os.path.getsize(dbfile) / 1024 / 1024, 1)})
+    return dbfile
+
+""" App states to drive the callbacks with: the top of the tree, then zooming into the biggest subtree depth times,
+    on each tab, for one site (and All on the explorer tab).
+"""
+def benchStates(dashboard, depth):
+    conn = dashboard.getConn()
+    state = json.loads(dashboard.cbController(None, None, None, None, 'explorer_tab', 1, None, None, '', 'name', None, None, [], [], 'app_state'))
+    site = [s for s in dashboard.sites if s != 'All'][0]
+    paths = [list(state['path'])]
+    # Path segments are everything after the parent's path, as cbController builds them when zooming
+    where = "parent_int=-1 and c_fullname like ?"
+    params = ('\\'.join(state['path']) + '\\%',)
+    for d in range(depth):
+        node = conn.execute("select c_fullname, fullname_int from bigfullname where %s and c_visualattributes not like 'L%%' order by hi-lo desc limit 1" % where, params).fetchone()
+        if node is None: break
+        path = list(paths[-1])
+        path.append(node[0][len('\\'.join(path)) + 1:-1])
+        paths.append(path)
+        where, params = "parent_int=?", (node[1],)
+
+    states = []
+    for d, path in enumerate(paths):
+        for tab, s in (('explorer_tab', 'All'), ('explorer_tab', site), ('siteoutlier_tab', site), ('missing_tab', site), ('hierarchy_tab', 'All')):
+            states.append(dict(state, action='', path=path, hlevel=int(state['minhlevel']) + d, site=s, tab=tab))
+    return states
+
+# Callbacks to time, as name and a function of the app state
+def benchCallbacks(dashboard):
+    return [('cbLoadData', lambda st: dashboard.cbLoadData(json.dumps(st))),
+            ('cbNavigateButtons', lambda st: dashboard.cbNavigateButtons(json.dumps(st), [], [])),
+            ('cbLineGraphButtons', lambda st: dashboard.cbLineGraphButtons(json.dumps(st), None, None)),
+            ('cbBarGraphButtons', lambda st: dashboard.cbBarGraphButtons(json.dumps(st), None)),
+            ('cbSiteoutlierGraph', lambda st: dashboard.cbSiteoutlierGraph(json.dumps(st), None, None)),
+            ('cbMissingMd', lambda st: dashboard.cbMissingMd(st['site'], json.dumps(st))),
+            ('cbDrops', lambda st: dashboard.cbDrops(st['site'])),
+            ('cbHierarchy', lambda st: dashboard.cbHierarchy(json.dumps(st)))]
+
+""" Time each dashboard callback on each state, capturing the SQL it issues with the sqlite trace callback,
+    then time each distinct statement on its own (best and median of repeat runs).
+"""
+def benchDashboard(stages, dbfile, depth=3, repeat=3):
+    try:
+        import totalnum_dashboard_v2 as dashboard
+    except ImportError as e:
+        print("Skipping the dashboard: " + str(e))
+        return [], []
+    stage(stages, 'dashboard initApp', dashboard.initApp, db=dbfile)
+    conn = dashboard.getConn()
+    callbacks, queries, statements = [], [], {}
+    traced = []
+    conn.set_trace_callback(traced.append)
+    for st in benchStates(dashboard, depth):
+        # Navigate, then select the first button (as if it was clicked) for the graphs
+        nav = dashboard.cbNavigateButtons(json.dumps(st), [], [])[0]
+        first = nav[0].id['index'] if nav else ''
+        # Each state starts with an empty result cache, so its first callback pays for the queries
+        dashboard.cache.clear()
+        for name, fn in benchCallbacks(dashboard):
+            cst = st if name in ('cbLoadData', 'cbNavigateButtons') else dict(st, action='navclick', selected=[first], selected_new=first)
+            del traced[:]
+            start = time.time()
+            fn(cst)
+            wall = time.time() - start
+            sqls = [s for s in traced if s.lstrip().lower().startswith(('select', 'with'))]
+            callbacks.append({'callback': name, 'tab': st['tab'], 'site': st['site'], 'depth': len(st['path']) - 1,
+                              'wall': wall, 'statements': [statements.setdefault(s, len(statements)) for s in sqls]})
+    conn.set_trace_callback(None)
+
+    for sql, i in statements.items():
+        times, nrows = [], 0
+        for r in range(repeat):
+            start = time.time()
+            nrows = len(conn.execute(sql).fetchall())
+            times.append(time.time() - start)
+        queries.append({'id': i, 'sql': sql, 'wall_min': min(times), 'wall_median': float(np.median(times)), 'rows': nrows,
+                        'callers': sorted(set(c['callback'] for c in callbacks if i in c['statements']))})
+    return callbacks, queries
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'numpy': np.__version__,
+            'pandas': pd.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+""" Print two results files side by side: stages, callbacks (totalled by name) and the slowest statements. """
+def compare(old, new):
+    with open(old) as f: a = json.load(f)
+    with open(new) as f: b = json.load(f)
+    def row(name, x, y):
+        print("%-45s %10.3f %10.3f %8s" % (name[:45], x, y, ('%.2fx' % (y / x)) if x else ''))
+    print("%-45s %10s %10s %8s" % ('stage (sec)', os.path.basename(old)[:10], os.path.basename(new)[:10], 'ratio'))
+    bstages = {s['stage']: s for s in b['stages'] if 'wall' in s}
+    for s in a['stages']:
+        if 'wall' in s and s['stage'] in bstages: row(s['stage'], s['wall'], bstages[s['stage']]['wall'])
+    print("%-45s %10s %10s" % ('peak memory (MB)', '', ''))
+    for s in a['stages']:
+        if 'wall' in s and s['stage'] in bstages: row(s['stage'], s['peak_rss_mb'], bstages[s['stage']]['peak_rss_mb'])
+    print("%-45s %10s %10s" % ('callbacks (sec, total)', '', ''))
+    total = lambda r, name: sum(c['wall'] for c in r['callbacks'] if c['callback'] == name)
+    for name in sorted(set(c['callback'] for c in a['callbacks'])):
+        row(name, total(a, name), total(b, name))
+    print("%-45s %10s %10s" % ('statements (sec, best)', '', ''))
+    print("  %d statements, %.3f sec -> %d statements, %.3f sec" % (len(a['queries']), sum(q['wall_min'] for q in a['queries']),
+                                                                 len(b['queries']), sum(q['wall_min'] for q in b['queries'])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the totalnum db build and dashboard queries on synthetic data")
+    parser.add_argument('--datadir', default='/tmp/totalnum_bench', help="Where the synthetic data (and db) go")
+    parser.add_argument('--paths', type=int, default=10000, help="Ontology size (10k to 2M)")
+    parser.add_argument('--sites', type=int, default=5, help="Number of sites (5 to 200)")
+    parser.add_argument('--refreshes', type=int, default=3, help="Reports per site (1 to 30)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help="Generate the data even if datadir already has it")
+    parser.add_argument('--jobs', type=int, default=1, help="Worker processes for generating and parsing reports")
+    parser.add_argument('--depth', type=int, default=3, help="How far down the tree to navigate in the dashboard")
+    parser.add_argument('--repeat', type=int, default=3, help="Times to run each SQL statement")
+    parser.add_argument('--no-dashboard', action='store_true', help="Only time the build")
+    parser.add_argument('--out', default=None, help="JSON results file, default bench_<time>.json in datadir")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="Compare two results files")
+    args = parser.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        exit()
+
+    stages = []
+    ontfile, reportdir = args.datadir + '/ontology.csv', args.datadir + '/reports'
+    config = {'paths': args.paths, 'sites': args.sites, 'refreshes': args.refreshes, 'seed': args.seed}
+    if args.regenerate or not os.path.exists(args.datadir + '/synth.json'):
+        stage(stages, 'generate', synth.generate, args.datadir, args.paths, args.sites, args.refreshes, args.seed, args.jobs)
+        with open(args.datadir + '/synth.json', 'w') as f:
+            json.dump(config, f)
+    else:
+        with open(args.datadir + '/synth.json') as f:
+            config = json.load(f)
+        print("Using the data in %s: %s" % (args.datadir, config))
+
+    dbfile = benchBuild(stages, ontfile, reportdir, args.jobs)
+    callbacks, queries = ([], []) if args.no_dashboard else benchDashboard(stages, dbfile, args.depth, args.repeat)
+
+    out = args.out if args.out else args.datadir + '/bench_%s.json' % time.strftime('%Y%m%d_%H%M%S')
+    with open(out, 'w') as f:
+        json.dump({'config': config, 'jobs': args.jobs, 'environment': environment(), 'run': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'stages': stages, 'callbacks': callbacks, 'queries': queries}, f, indent=1)
+    print("\n%-45s %10s %10s" % ('stage', 'sec', 'peak MB'))
+    for s in stages:
+        if 'wall' in s: print("%-45s %10.2f %10.0f" % (s['stage'], s['wall'], s['peak_rss_mb']))
+    if queries:
+        print("%d callback calls, %.2f sec; %d distinct statements, %.2f sec" % (len(callbacks), sum(c['wall'] for c in callbacks),
+                                                                              len(queries), sum(q['wall_min'] for q in queries)))
+        for q in sorted(queries, key=lambda q: -q['wall_min'])[:5]:
+            print("  %.3f sec, %d rows: %s" % (q['wall_min'], q['rows'], ' '.join(q['sql'].split())[:150]))
+    print("Results saved to " + out)
@@ -0,0 +1,179 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+"""
+Synthetic ACT-like data for benchmarking totalnum_builddb_v2 and the dashboard.
+Writes an ontology file (c_fullname, c_name, c_hlevel, c_visualattributes, c_tooltip) and report_<site>_<refresh>.csv
+files (C_FULLNAME, AGG_DATE, AGG_COUNT) shaped like the real ones: domain roots behind ACT version segments, a COVID
+denominator concept, counts that shrink down the hierarchy, sites of different sizes that are each missing some
+subtrees, growth between refreshes, and small counts obfuscated as -1.
+
+Usage: python -m benchmark.synth --outdir /tmp/synth --paths 100000 --sites 20 --refreshes 5
+"""
+
+# Domain roots (with the intermediate nodes above them) and their share of the generated paths
+domains = [
+    (['\\ACT\\Diagnosis\\', '\\ACT\\Diagnosis\\ICD10\\', '\\ACT\\Diagnosis\\ICD10\\V2_2018AA\\A20098492\\'], 'Diagnoses', 0.35),
+    (['\\ACT\\Procedures\\', '\\ACT\\Procedures\\CPT4\\V2_2018AA\\A23576389\\'], 'Procedures', 0.2),
+    (['\\ACT\\Lab\\', '\\ACT\\Lab\\LOINC\\V2_2018AA\\'], 'Labs', 0.25),
+    (['\\ACT\\Medications\\', '\\ACT\\Medications\\MedicationsByVaClass\\V2_09302018\\'], 'Medications', 0.2),
+]
+# The anal_denom concept
+denominator = ['\\ACT\\UMLS_C0031437\\', '\\ACT\\UMLS_C0031437\\SNOMED_3947185011\\']
+
+""" Build the ontology as a DataFrame with c_fullname, c_name, c_hlevel, c_visualattributes, c_tooltip, plus parent
+    (row number of the parent, -1 for roots), share (fraction of the parent's patients), depth, and lo and hi (the
+    node's pre-order rank, and the end of its subtree's ranks), which the reports use.
+    Rows are in breadth-first order within each domain, so a parent always comes before its children.
+"""
+def makeOntology(npaths, seed=0, fanout=8):
+    rng = np.random.default_rng(seed)
+    fullname, name, parent, share = [], [], [], []
+    def add(path, label, par, frac):
+        fullname.append(path); name.append(label); parent.append(par); share.append(frac)
+        return len(fullname) - 1
+    for chain, label, _ in domains + [(denominator, 'COVID-19 positive', 0)]:
+        par = -1
+        for depth, path in enumerate(chain):
+            par = add(path, label if depth == 0 else label + ' ' + path.split('\\')[-2], par, 1.0 if depth else 0.6)
+    denom = len(fullname) - 1
+    budget = max(npaths - len(fullname), 0)
+    for chain, label, weight in domains:
+        top = fullname.index(chain[-1])
+        want = int(budget * weight)
+        level = [top]
+        while want > 0 and level:
+            nextlevel = []
+            for p in level:
+                k = min(int(rng.integers(1, 2 * fanout)), want)
+                fracs = rng.beta(0.6, 3.0, k)
+                for i in range(k):
+                    seg = '%s%d' % (label[0], len(fullname))
+                    nextlevel.append(add(fullname[p] + seg + '\\', '%s %s' % (label, seg), p, fracs[i]))
+                want -= k
+                if want <= 0: break
+            level = nextlevel
+    # A few children for the denominator, and the any lab test denominator under it
+    for i in range(5):
+        add(fullname[denom] + 'C%d\\' % i, 'COVID-19 positive %d' % i, denom, rng.beta(0.6, 3.0))
+    add(fullname[denom] + 'UMLS_C0022885\\', 'COVID-19 positive with any lab test', denom, 0.8)
+
+    parent = np.array(parent, dtype='int64')
+    leaf = np.ones(len(fullname), dtype=bool)
+    leaf[parent[parent >= 0]] = False
+    df = pd.DataFrame({'c_fullname': fullname, 'c_name': name,
+                       'c_hlevel': [p.count('\\') - 2 for p in fullname],
+                       'c_visualattributes': np.where(leaf, 'LA', 'FA'),
+                       'parent': parent, 'share': share})
+    df['depth'], df['lo'], df['hi'] = preorder(parent)
+    df.loc[parent < 0, 'c_visualattributes'] = 'CA'
+    df['c_tooltip'] = [' \\ '.join(p.split('\\')[2:-1]) for p in fullname]
+    return df
+
+""" Depth, pre-order rank (lo) and subtree end (hi) of each node, from the parent row numbers (-1 for roots), so the
+    subtree of a node is the ranks lo to hi-1. Siblings are ranked in row order. Works a level at a time, with array
+    operations over all the nodes of a level.
+"""
+def preorder(parent):
+    n = len(parent)
+    depth = np.zeros(n, dtype='int64')
+    anc = parent.copy()
+    while (anc >= 0).any():
+        depth += anc >= 0
+        anc = np.where(anc >= 0, parent[np.maximum(anc, 0)], -1)
+    levels = [np.flatnonzero(depth == d) for d in range(depth.max() + 1)] if n else []
+    # Subtree sizes, bottom up
+    size = np.ones(n, dtype='int64')
+    for idx in levels[:0:-1]:
+        np.add.at(size, parent[idx], size[idx])
+    # Each node's offset among its siblings: the sizes of the siblings before it
+    order = np.lexsort((np.arange(n), parent))
+    cum = np.cumsum(size[order]) - size[order]
+    first = np.r_[True, parent[order][1:] != parent[order][:-1]] if n else np.zeros(0, dtype=bool)
+    offset = np.empty(n, dtype='int64')
+    offset[order] = cum - cum[np.flatnonzero(first)][np.cumsum(first) - 1]
+    # Ranks, top down
+    lo = offset.copy()
+    for idx in levels[1:]:
+        lo[idx] = lo[parent[idx]] + 1 + offset[idx]
+    return depth, lo, lo + size
+
+# Expected patients per concept at a site of size 1: the product of shares down from the root
+def baseCounts(ontology, patients=1000000):
+    parent = ontology['parent'].to_numpy()
+    depth = ontology['depth'].to_numpy()
+    base = ontology['share'].to_numpy() * patients
+    # A level at a time, top down, multiplies down the tree
+    for d in range(1, depth.max() + 1):
+        idx = np.flatnonzero(depth == d)
+        base[idx] *= base[parent[idx]] / patients
+    return base
+
+# Set in each worker by workerInit (or by generate, without workers): c_fullname, base counts, lo and hi
+synthdata = None
+
+def workerInit(fullnames, base, lo, hi):
+    global synthdata
+    synthdata = (fullnames, base, lo, hi)
+
+""" Write the reports for one site: one file per refresh. Each site is missing a few random subtrees, is a random
+    size, and grows a little each refresh. Counts under 10 are obfuscated as -1, and zero counts are left out.
+"""
+def writeSite(args):
+    outdir, site, nrefreshes, seed = args
+    fullnames, base, lo, hi = synthdata
+    rng = np.random.default_rng(seed)
+    n = len(base)
+    # Missing subtrees: a dropped node drops the ranks lo..hi-1, marked as +1/-1 at the ends of each range
+    roots = np.flatnonzero(rng.random(n) < 0.005)
+    marks = np.zeros(n + 1, dtype='int64')
+    np.add.at(marks, lo[roots], 1)
+    np.add.at(marks, hi[roots], -1)
+    dropped = (np.cumsum(marks[:n]) > 0)[lo]
+    coverage = ~dropped & (rng.random(n) < 0.97)
+    scale = rng.lognormal(0, 0.8)
+    fullnames = fullnames[coverage]
+    for r in range(nrefreshes):
+        date = (np.datetime64('2020-01-01') + np.timedelta64(90 * r, 'D')).astype(str)
+        counts = np.round(base[coverage] * scale * (1 + 0.05 * r) * rng.lognormal(0, 0.05, len(fullnames))).astype('int64')
+        counts[(counts > 0) & (counts < 10)] = -1
+        keep = counts != 0
+        pd.DataFrame({'C_FULLNAME': fullnames[keep], 'AGG_DATE': date, 'AGG_COUNT': counts[keep]}).to_csv(
+            outdir + '/report_%s_r%d.csv' % (site, r), index=False)
+    return site
+
+""" Write the ontology file (ontology.csv) and reports (in reports/) to outdir. Returns (ontology file, reports dir). """
+def generate(outdir, npaths=10000, nsites=5, nrefreshes=3, seed=0, jobs=1):
+    start = time.time()
+    os.makedirs(outdir + '/reports', exist_ok=True)
+    ontology = makeOntology(npaths, seed)
+    ontfile = outdir + '/ontology.csv'
+    ontology[['c_fullname', 'c_name', 'c_hlevel', 'c_visualattributes', 'c_tooltip']].to_csv(ontfile, index=False)
+    # The workers get the ontology arrays once, rather than with every site
+    data = (ontology['c_fullname'].to_numpy(), baseCounts(ontology), ontology['lo'].to_numpy(), ontology['hi'].to_numpy())
+    work = [(outdir + '/reports', 'SITE%03d' % s, nrefreshes, seed * 1000 + s) for s in range(nsites)]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=workerInit, initargs=data) as pool:
+            list(pool.map(writeSite, work))
+    else:
+        workerInit(*data)
+        for w in work:
+            writeSite(w)
+    print("Generated %d paths, %d sites x %d refreshes in %.1f sec" % (len(ontology), nsites, nrefreshes, time.time() - start))
+    return ontfile, outdir + '/reports'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic ACT-like ontology and totalnum report files")
+    parser.add_argument('--outdir', required=True)
+    parser.add_argument('--paths', type=int, default=10000, help="Ontology size (10k to 2M)")
+    parser.add_argument('--sites', type=int, default=5, help="Number of sites (5 to 200)")
+    parser.add_argument('--refreshes', type=int, default=3, help="Reports per site (1 to 30)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=1, help="Worker processes for writing reports")
+    args = parser.parse_args()
+    generate(args.outdir, args.paths, args.sites, args.refreshes, args.seed, args.jobs)
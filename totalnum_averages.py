@@ -0,0 +1,115 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import totalnum_dbconn
+
+"""
+Network-wide averages for the ACT manuscript: for every concept in bigfullname, the mean, median and interquartile
+range of the percent of patients at each participating site (totalnums_pct, built by totalnum_builddb_v2, for one
+denominator), and the number of sites that contribute.
+
+Sites report counts under 10 (or counts they obfuscate) as negative numbers, so these are never averaged as they are:
+by default they are left out (but counted in n_suppressed), or with negative='zero' they count as 0%. Concepts with
+fewer than minsites contributing sites have their statistics suppressed (left blank), so no single site's numbers can be
+read from the file.
+
+The statistics are computed a fullname_int range at a time with array operations over all the concepts in the range
+(no per-concept loop), and each range is appended to the output as it is done, so memory is bounded by the chunk.
+Output is CSV, or Parquet (needs pyarrow) if the file name ends in .parquet.
+
+Usage: python totalnum_averages.py --db /path/to/totalnums.db --out averages.csv
+"""
+
+# Number of fullname_ints read at a time
+avgchunk = 200000
+
+columns = ['c_fullname', 'c_name', 'n_sites', 'n_suppressed', 'mean', 'median', 'q1', 'q3', 'iqr']
+
+""" Quantile q of each group of x, where x is sorted within groups that start at starts and have n (> 0) values,
+    interpolated linearly like numpy's default.
+"""
+def groupQuantile(x, starts, n, q):
+    pos = starts + q * (n - 1)
+    lo = np.floor(pos).astype('int64')
+    hi = np.minimum(lo + 1, starts + n - 1)
+    return x[lo] + (x[hi] - x[lo]) * (pos - lo)
+
+""" Statistics of each concept's site percents, for fullname_ints f and percents pct (any order). names is a
+    DataFrame of c_fullname and c_name indexed by fullname_int, for all of the concepts to report.
+"""
+def averages(f, pct, names, negative='drop', minsites=3):
+    suppressed = pct < 0
+    nsuppressed = pd.Series(np.bincount(f[suppressed]), dtype='int64') if suppressed.any() else pd.Series(dtype='int64')
+    if negative == 'zero':
+        pct = np.where(suppressed, 0.0, pct)
+    else:
+        f, pct = f[~suppressed], pct[~suppressed]
+    order = np.lexsort((pct, f))
+    f, pct = f[order], pct[order]
+    ids, starts, n = np.unique(f, return_index=True, return_counts=True)
+    mean = np.add.reduceat(pct, starts) / n if len(f) else np.zeros(0)
+    q1, median, q3 = (groupQuantile(pct, starts, n, q) for q in (0.25, 0.5, 0.75))
+    stats = pd.DataFrame({'n_sites': n, 'mean': mean, 'median': median, 'q1': q1, 'q3': q3, 'iqr': q3 - q1}, index=ids)
+    out = names.join(stats)
+    out['n_sites'] = out['n_sites'].fillna(0).astype('int64')
+    out['n_suppressed'] = nsuppressed.reindex(out.index).fillna(0).astype('int64')
+    out.loc[out['n_sites'] < minsites, ['mean', 'median', 'q1', 'q3', 'iqr']] = np.nan
+    return out[columns]
+
+""" Write the averages for every concept to out, computed from the percents for denom (default: the db's default
+    denominator).
+"""
+def exportAverages(db, out, denom=None, negative='drop', minsites=3):
+    start = time.time()
+    conn = totalnum_dbconn.ConnectionManager("SQLITE", db).get()
+    if denom is None:
+        # dbs built without denominators (or before they were stored) have no default
+        row = conn.execute("select denom from denominators order by ord limit 1").fetchone() \
+            if conn.execute("select 1 from sqlite_master where type='table' and name='denominators'").fetchone() else None
+        if row is None:
+            conn.close()
+            raise ValueError("No denominators in %s, so give one with --denominator (or rebuild it with totalnum_builddb_v2)" % db)
+        denom = row[0]
+    print("Network-wide averages of the percent of the %s denominator, %s negative counts, at least %d sites..." % (denom,
+          'zeroing' if negative == 'zero' else 'leaving out', minsites))
+    parquet = out.endswith('.parquet')
+    writer = None
+    if parquet:
+        import pyarrow
+        import pyarrow.parquet
+    tmp = out + '.tmp'
+    maxint = conn.execute("select max(fullname_int) from bigfullname").fetchone()[0] or 0
+    nconcepts = nreported = 0
+    for lo in range(0, maxint + 1, avgchunk):
+        params = (lo, lo + avgchunk)
+        names = pd.read_sql_query("select fullname_int, c_fullname, c_name from bigfullname where fullname_int>=? and fullname_int<?",
+                                  conn, params=params).drop_duplicates('fullname_int').set_index('fullname_int').sort_index()
+        rows = np.fromiter(conn.execute("select fullname_int, pct from totalnums_pct where denom=? and pct is not null and fullname_int>=? and fullname_int<?",
+                                        (denom,) + params), dtype=[('f', 'int64'), ('pct', 'float64')])
+        df = averages(rows['f'], rows['pct'], names, negative, minsites)
+        if parquet:
+            table = pyarrow.Table.from_pandas(df, preserve_index=False)
+            if writer is None: writer = pyarrow.parquet.ParquetWriter(tmp, table.schema)
+            writer.write_table(table)
+        else:
+            df.to_csv(tmp, mode='w' if lo == 0 else 'a', header=(lo == 0), index=False, float_format='%.4f')
+        nconcepts += len(df)
+        nreported += int(df['mean'].notna().sum())
+    if writer is not None: writer.close()
+    conn.close()
+    os.replace(tmp, out)
+    print("Wrote %d concepts (%d with averages) to %s in %.1f sec" % (nconcepts, nreported, out, time.time() - start))
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Export network-wide averages of the percent of patients at each site, for every concept")
+    parser.add_argument('--db', required=True, help="The totalnums.db built by totalnum_builddb_v2")
+    parser.add_argument('--out', default='network_averages.csv', help="Output file, .csv or .parquet")
+    parser.add_argument('--denominator', default=None, help="Denominator for the percents (default: the db's default)")
+    parser.add_argument('--negative', choices=['drop', 'zero'], default='drop', help="Leave out negative (suppressed or obfuscated) counts, or count them as 0%%")
+    parser.add_argument('--min-sites', type=int, default=3, help="Suppress the statistics of concepts with fewer contributing sites")
+    args = parser.parse_args()
+    exportAverages(args.db, args.out, args.denominator, args.negative, args.min_sites)
@@ -1,11 +1,25 @@
+import argparse
+import bz2
 import datetime as dt
+import gzip
+import hashlib
+import os
 import sqlite3
+import time
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
 from os import listdir
 
 import numpy as np
 import pandas as pd
 import math
 
+import totalnum_cube
+
 """
 ISSUES 12-15
 NCATS_DEMOGRAPHICS and visit details - not even there
@@ -21,11 +35,13 @@ Visit details not there
 
 """
   New version loads totalnum reports into a SQLite3 db from basedir (below) with the name format report_[siteid]_[foo].csv.
+  Reports can also be compressed (.csv.gz, .csv.bz2, .csv.zst) or in .zip bundles, which are read without unpacking them.
   Columns must be (in order) c_fullname, agg_date, agg_count. (Case insensitive on column names however.)
   Date format for agg_date (as enforced by the totalnum report script), should be YYYY-MM-DD, but the python parser can handle others.
   Bigfullnamefile must be a file with all possible paths (e.g., from the concept dimension) with columns: c_fullname, c_name.
   hlevel and "domain" are inferred.
   SQLite db uses a totalnum_int column in the totalnums table and puts this for reference in bigfullname.
+  (totalnums is now a view over the compact totalnums_int table, which also stores the site as site_int and the date as a day number.)
 
  By Jeff Klann, PhD 05-2020
 """
@@ -63,14 +79,396 @@ class StdevFunc:
             return None
         return math.sqrt(self.S / (self.k-2))
 
+# Denominator concepts for the percent tables, as name: c_fullname. The first is the default. Set with --denominator,
+# which is remembered in the db's denominators table for later builds.
+denominators = {'covid': '\\ACT\\UMLS_C0031437\\SNOMED_3947185011\\', # Any pt in COVID ontology
+                'lab': '\\ACT\\UMLS_C0031437\\SNOMED_3947185011\\UMLS_C0022885\\'} # Any lab test, better if the site has lab tests
+
 basedir = "/Users/jeffklann/HMS/Projects/ACT/totalnum_data/reports"
 bigfullnamefile = '/Users/jeffklann/HMS/Projects/ACT/totalnum_data/ACT_paths_full.csv' # ACT_covid_paths_v3.csv
-conn = sqlite3.connect(basedir + '/totalnums.db')
-conn.create_aggregate("stdev", 1, StdevFunc)
+conn = None
+
+# Open the totalnums db (once) and register the stdev aggregate. Defaults to totalnums.db in basedir.
+def openDb(dbfile=None):
+    global conn
+    if conn is None:
+        conn = sqlite3.connect(dbfile if dbfile else basedir + '/totalnums.db')
+        conn.create_aggregate("stdev", 1, StdevFunc)
+    return conn
+
+""" Materialize the most recent totalnum for each fullname_int and site in totalnums_recent.
+    If changed_sites is given (from an incremental buildDb), only those sites' rows are refreshed.
+"""
+def postProcessRecent(changed_sites=None):
+    cur = openDb().cursor()
+    recent = """select t.fullname_int, datetime(t.agg_date*86400, 'unixepoch'), t.agg_count, s.site from totalnums_int t inner join
+        (select fullname_int, site_int, max(agg_date) agg_date from totalnums_int {where} group by fullname_int, site_int) x
+         on x.fullname_int=t.fullname_int and x.site_int=t.site_int and x.agg_date=t.agg_date
+        inner join sites s on s.site_int=t.site_int"""
+    if changed_sites is None or objectType('totalnums_recent') != 'table':
+        print("Materializing totalnums_recent...")
+        dropObject('totalnums_recent') # Older dbs have a view here
+        cur.execute("create table totalnums_recent (fullname_int integer, agg_date timestamp, agg_count integer, site text)")
+        cur.execute("insert into totalnums_recent " + recent.format(where=''))
+        cur.execute("create index totalnums_recent_fs on totalnums_recent(fullname_int, site)")
+        # Covering index for site lookups (e.g., missingness)
+        cur.execute("create index totalnums_recent_sf on totalnums_recent(site, fullname_int, agg_count)")
+    elif len(changed_sites) > 0:
+        print("Refreshing totalnums_recent for " + ','.join(sorted(changed_sites)))
+        sites = sorted(changed_sites)
+        marks = ','.join('?' * len(sites))
+        cur.execute("delete from totalnums_recent where site in (%s)" % marks, sites)
+        cur.execute("insert into totalnums_recent " + recent.format(where='where site_int in (select site_int from sites where site in (%s))' % marks), sites)
+    conn.commit()
+    cur.close()
+
+""" Per-concept statistics across sites, computed with a pandas groupby instead of the StdevFunc SQLite aggregate.
+    df has a fullname_int column and a value column col, already limited to the values that count (e.g., agg_count>-1).
+    Same semantics as the old SQL: stdev is the sample stdev, and concepts reported by only one site are dropped.
+    Also computes the median and MAD (median absolute deviation, unscaled) for robust outlier detection.
+"""
+def siteStats(df, col):
+    g = df.groupby('fullname_int')[col]
+    stat = pd.DataFrame({'average': g.mean(), 'stdev': g.std(ddof=1), 'num_sites': g.size(), 'median': g.median()})
+    dev = (df[col] - df['fullname_int'].map(stat['median'])).abs()
+    stat['mad'] = dev.groupby(df['fullname_int']).median()
+    return stat[stat['num_sites'] > 1]
+
+# Read (fullname_int, value) rows straight into typed arrays - much cheaper than read_sql for millions of rows
+def readValues(sql, col, params=()):
+    arr = np.fromiter(conn.execute(sql, params), dtype=[('fullname_int', 'int64'), (col, 'float64')])
+    return pd.DataFrame(arr)
+
+# Number of fullname_ints whose rows are read at a time when computing statistics
+statchunk = 200000
+
+# The per-concept statistics (siteStats) of source's col where valid, in the temp table outlier_stats, a chunk at a time
+def outlierStats(source, col, valid, params=()):
+    cur = conn.cursor()
+    cur.execute("drop table if exists outlier_stats")
+    cur.execute("create temp table outlier_stats (fullname_int integer primary key, average real, stdev real, num_sites integer, median real, mad real)")
+    maxint = conn.execute("select max(fullname_int) from bigfullname").fetchone()[0] or 0
+    for lo in range(0, maxint + 1, statchunk):
+        df = readValues("select fullname_int, %s from %s where %s and fullname_int>=? and fullname_int<?" % (col, source, valid), col, tuple(params) + (lo, lo + statchunk))
+        stat = siteStats(df, col)
+        cur.executemany("insert into outlier_stats values (?,?,?,?,?,?)", stat.reset_index().astype('object').itertuples(index=False, name=None))
+    cur.close()
+
+""" Materialize a site outlier table: every row of source joined to its concept's statistics over the rows where valid.
+    The statistics are computed a fullname_int range at a time, so memory is bounded by the chunk, not the network,
+    and only the (small) per-concept statistics go back through Python - the join is done in SQL.
+"""
+def outlierTable(table, source, col, valid):
+    cur = conn.cursor()
+    outlierStats(source, col, valid)
+    cur.execute("drop table if exists " + table)
+    cur.execute("create table %s (fullname_int integer, agg_date timestamp, %s integer, site text, average real, stdev real, num_sites integer, median real, mad real)" % (table, col))
+    cur.execute("""insert into %s select r.fullname_int, r.agg_date, r.%s, r.site, average, stdev, num_sites, median, mad
+        from %s r inner join outlier_stats s on s.fullname_int=r.fullname_int""" % (table, col, source))
+    cur.execute("create index %s_f on %s(fullname_int)" % (table, table))
+    cur.execute("drop table outlier_stats")
+    cur.close()
+    conn.commit()
+
+""" The site outlier table for percents (outliers_sites_pct), like outlierTable but with the statistics computed per
+    denominator, from totalnums_pct. It has a denom column, and is indexed by denominator and concept.
+"""
+def outlierTablePct():
+    cur = conn.cursor()
+    cur.execute("drop table if exists outliers_sites_pct")
+    cur.execute("""create table outliers_sites_pct (denom text, fullname_int integer, agg_date timestamp, pct real, site text, average real,
+        stdev real, num_sites integer, median real, mad real)""")
+    for denom in [r[0] for r in conn.execute("select denom from denominators order by ord")]:
+        outlierStats('totalnums_pct', 'pct', 'denom=? and pct>=0', (denom,))
+        cur.execute("""insert into outliers_sites_pct select r.denom, r.fullname_int, r.agg_date, r.pct, r.site, average, stdev, num_sites, median, mad
+            from totalnums_pct r inner join outlier_stats s on s.fullname_int=r.fullname_int where r.denom=?""", (denom,))
+        cur.execute("drop table outlier_stats")
+    cur.execute("create index outliers_sites_pct_df on outliers_sites_pct(denom, fullname_int)")
+    cur.close()
+    conn.commit()
+
+""" Materialize the denominators and percent tables, for each of the denominators (name: c_fullname, in order):
+    denominators - the denominator concepts; the first (ord 0) is the default
+    totalnums_denom - each denominator's most recent count at each site (sites where it is 0 or suppressed are left out)
+    totalnums_pct - each most recent count as a percent of each denominator at its site, as a float. Suppressed counts
+      (-1) come out negative, so pct>=0 selects the real ones.
+    anal_denom and totalnums_recent_pct are views of the default denominator, with the columns they had as views.
+"""
+def postProcessDenominators(denoms=None):
+    start = time.time()
+    denoms = denoms if denoms is not None else denominators
+    print("Computing percents for denominators " + ','.join(denoms))
+    cur = openDb().cursor()
+    cur.execute("drop table if exists denominators")
+    cur.execute("create table denominators (denom text primary key, c_fullname text, ord integer)")
+    cur.executemany("insert into denominators values (?,?,?)", [(d, path, i) for i, (d, path) in enumerate(denoms.items())])
+    for name in ('anal_denom', 'totalnums_recent_pct'):
+        dropObject(name) # Views (or a table) in older dbs
+    cur.execute("drop table if exists totalnums_denom")
+    cur.execute("create table totalnums_denom (denom text, site text, denominator integer, primary key (denom, site)) without rowid")
+    cur.execute("""insert or replace into totalnums_denom select d.denom, r.site, r.agg_count from denominators d
+        inner join (select distinct c_fullname, fullname_int from bigfullname) b on b.c_fullname=d.c_fullname
+        inner join totalnums_recent r on r.fullname_int=b.fullname_int where r.agg_count>0""")
+    cur.execute("drop table if exists totalnums_pct")
+    cur.execute("create table totalnums_pct (denom text, fullname_int integer, agg_date timestamp, pct real, site text)")
+    cur.execute("""insert into totalnums_pct select d.denom, r.fullname_int, r.agg_date, 100.0 * r.agg_count / d.denominator, r.site
+        from totalnums_denom d inner join totalnums_recent r on r.site=d.site order by d.denom, r.fullname_int""")
+    cur.execute("create index totalnums_pct_dfs on totalnums_pct(denom, fullname_int, site)")
+    cur.execute("""create view anal_denom as select site, denominator from totalnums_denom
+        where denom=(select denom from denominators where ord=0)""")
+    cur.execute("""create view totalnums_recent_pct as select fullname_int, agg_date, pct, site from totalnums_pct
+        where denom=(select denom from denominators where ord=0)""")
+    for denom, n in conn.execute("select d.denom, count(t.site) from denominators d left join totalnums_denom t on t.denom=d.denom group by d.denom order by d.ord"):
+        print("  %s: %d sites" % (denom, n))
+    conn.commit()
+    cur.close()
+    print("Percents took %.1f sec" % (time.time() - start))
+
+# Site outliers: compute avg and stdev (and median and MAD).
+def postProcessOutliers():
+    start = time.time()
+    print("Computing site outliers...")
+    outlierTable('outliers_sites', 'totalnums_recent', 'agg_count', 'agg_count>-1')
+    outlierTablePct()
+    print("Site outliers took %.1f sec" % (time.time() - start))
+
+# Time the old SQL/StdevFunc statistics against siteStats() and check they agree
+def compareOutlierStats():
+    openDb()
+    start = time.time()
+    old = pd.read_sql("""select fullname_int,avg(agg_count) average, stdev(agg_count) stdev, count(*) num_sites from totalnums_recent r
+        where agg_count>-1 group by fullname_int""", conn, index_col='fullname_int')
+    old = old[old['num_sites'] > 1]
+    sqltime = time.time() - start
+    start = time.time()
+    df = readValues("select fullname_int, agg_count from totalnums_recent where agg_count>-1", 'agg_count')
+    readtime = time.time() - start
+    new = siteStats(df, 'agg_count')
+    pdtime = time.time() - start
+    print("SQL stdev aggregate: %.3f sec, pandas: %.3f sec (%.3f reading, %.3f computing) - %.1fx" % (sqltime, pdtime, readtime,
+          pdtime - readtime, sqltime / max(pdtime, 1e-9)))
+    print("Concepts: %d vs %d, max difference in average: %g, stdev: %g" % (len(old), len(new),
+          (old['average'] - new['average']).abs().max(), (old['stdev'] - new['stdev']).abs().max()))
+
+""" Missingness bitsets per concept, over the sites in site_int order (site i is bit i%8 of byte i//8):
+    present - sites whose most recent count is nonzero
+    missing_subtree - sites where this concept or any descendant is missing, i.e. not present at that site but present
+      at another one
+    "Missing at site S but present elsewhere" is then a bit test, and a parent knows whether anything under it is missing.
+    Concepts with no bits set in either are left out of missing_bits.
+"""
+def postProcessMissing():
+    start = time.time()
+    print("Computing missingness bitsets...")
+    site_ints = np.array([r[0] for r in conn.execute("select site_int from sites order by site_int")], dtype='int64')
+    nodes = np.array(conn.execute("select fullname_int, parent_int from bigfullname").fetchall(), dtype='int64').reshape(-1, 2)
+    size = int(nodes[:, 0].max()) + 1 if len(nodes) else 0
+    nbytes = (len(site_ints) + 7) // 8
+    bit_of = np.zeros(int(site_ints.max()) + 1 if len(site_ints) else 0, dtype='int64')
+    bit_of[site_ints] = np.arange(len(site_ints))
+
+    present = np.zeros((size, nbytes), dtype='uint8')
+    pairs = np.fromiter(conn.execute("""select r.fullname_int, s.site_int from totalnums_recent r inner join sites s on s.site=r.site
+        where r.agg_count!=0"""), dtype=[('f', 'int64'), ('s', 'int64')])
+    pairs = pairs[pairs['f'] < size]
+    bits = bit_of[pairs['s']]
+    np.bitwise_or.at(present, (pairs['f'], bits // 8), np.left_shift(1, bits % 8).astype('uint8'))
+
+    # Missing here = not present here, but present somewhere
+    allsites = np.packbits(np.ones(len(site_ints), dtype=bool), bitorder='little')
+    subtree = np.where(present.any(axis=1, keepdims=True), ~present & allsites, 0).astype('uint8')
+
+    # Roll up the hierarchy, deepest nodes first: OR each node's subtree bits into its parent
+    parent = np.full(size, -1, dtype='int64')
+    parent[nodes[:, 0]] = nodes[:, 1]
+    depth = np.zeros(size, dtype='int64')
+    anc = parent.copy()
+    while (anc >= 0).any():
+        up = anc >= 0
+        depth[up] += 1
+        anc[up] = parent[anc[up]]
+    for d in range(int(depth.max()) if size else 0, 0, -1):
+        at = np.flatnonzero(depth == d)
+        np.bitwise_or.at(subtree, parent[at], subtree[at])
+
+    cur = conn.cursor()
+    cur.execute("drop table if exists missing_bits")
+    cur.execute("create table missing_bits (fullname_int integer primary key, present blob, missing_subtree blob)")
+    keep = np.flatnonzero(present.any(axis=1) | subtree.any(axis=1))
+    cur.executemany("insert into missing_bits values (?,?,?)", ((int(f), present[f].tobytes(), subtree[f].tobytes()) for f in keep))
+    cur.close()
+    conn.commit()
+    print("Missingness bitsets took %.1f sec" % (time.time() - start))
+
+""" Materialize the max and most recent count of each concept at each site in totalnums_rollup, for the dashboard's
+    cross-site view. Its primary key starts with the concept's parent, so the table is clustered by parent (without rowid)
+    and all of a level's children at every site are one range read. If changed_sites is given (from an incremental
+    buildDb), only those sites' rows are recomputed.
+"""
+def postProcessRollup(changed_sites=None):
+    start = time.time()
+    cur = openDb().cursor()
+    rollup = """select b.parent_int, m.fullname_int, s.site, m.max_count, r.agg_count, r.agg_date
+        from (select fullname_int, site_int, max(agg_count) max_count from totalnums_int {where} group by fullname_int, site_int) m
+        inner join sites s on s.site_int=m.site_int
+        inner join (select distinct fullname_int, parent_int from bigfullname) b on b.fullname_int=m.fullname_int
+        left join totalnums_recent r on r.fullname_int=m.fullname_int and r.site=s.site
+        order by b.parent_int, m.fullname_int, s.site"""
+    if changed_sites is None or not tableExists('totalnums_rollup'):
+        print("Materializing totalnums_rollup...")
+        cur.execute("drop table if exists totalnums_rollup")
+        cur.execute("""create table totalnums_rollup (parent_int integer, fullname_int integer, site text, max_count integer,
+            recent_count integer, recent_date timestamp, primary key (parent_int, fullname_int, site)) without rowid""")
+        cur.execute("insert into totalnums_rollup " + rollup.format(where=''))
+    elif len(changed_sites) > 0:
+        print("Refreshing totalnums_rollup for " + ','.join(sorted(changed_sites)))
+        sites = sorted(changed_sites)
+        marks = ','.join('?' * len(sites))
+        cur.execute("delete from totalnums_rollup where site in (%s)" % marks, sites)
+        cur.execute("insert into totalnums_rollup " + rollup.format(where='where site_int in (select site_int from sites where site in (%s))' % marks), sites)
+    conn.commit()
+    cur.close()
+    print("Site rollup took %.1f sec" % (time.time() - start))
+
+# A child is only flagged if its count is more than this many patients above its parent's (counts are obfuscated)
+hierarchyslack = 0
+
+""" Find every (child, parent, site, refresh) where the child concept has more patients than its parent at the same
+    site and refresh date - a hierarchy consistency bug - and write them to hierarchy_violations. For each site, its
+    rows are keyed by (fullname_int, day), and each row's parent row is found by a binary search of the sorted keys for
+    (parent_int, day), so all of the comparisons are array operations rather than LIKE self-joins. Only the direct
+    parent (bigfullname.parent_int) is compared, which is enough: a child over any ancestor is over some parent on
+    the way up. Suppressed counts (-1) are not compared.
+    The table's primary key starts with the child's pre-order rank (bigfullname.lo), so the violations under a path are
+    one range read for the dashboard. If changed_sites is given (from an incremental buildDb), only those sites are
+    rechecked.
+"""
+def postProcessHierarchy(changed_sites=None):
+    start = time.time()
+    cur = openDb().cursor()
+    sitenames = dict(conn.execute("select site_int, site from sites").fetchall())
+    if changed_sites is None or not tableExists('hierarchy_violations'):
+        print("Checking child counts against their parents...")
+        cur.execute("drop table if exists hierarchy_violations")
+        cur.execute("""create table hierarchy_violations (lo integer, site text, agg_date timestamp, fullname_int integer, parent_int integer,
+            child_count integer, parent_count integer, excess integer, primary key (lo, site, agg_date)) without rowid""")
+        check = sorted(sitenames)
+    elif len(changed_sites) > 0:
+        print("Rechecking child counts against their parents for " + ','.join(sorted(changed_sites)))
+        cur.execute("delete from hierarchy_violations where site in (%s)" % ','.join('?' * len(changed_sites)), sorted(changed_sites))
+        check = sorted(s for s in sitenames if sitenames[s] in changed_sites)
+    else:
+        return
+    nodes = np.array(conn.execute("select distinct fullname_int, parent_int, lo from bigfullname").fetchall(), dtype='int64').reshape(-1, 3)
+    size = int(nodes[:, 0].max()) + 1 if len(nodes) else 0
+    parent = np.full(size, -1, dtype='int64')
+    parent[nodes[:, 0]] = nodes[:, 1]
+    rank = np.zeros(size, dtype='int64')
+    rank[nodes[:, 0]] = nodes[:, 2]
+    found = 0
+    for site_int in check:
+        rows = np.fromiter(conn.execute("select fullname_int, agg_date, agg_count from totalnums_int where site_int=? and agg_count>-1", (site_int,)),
+                           dtype=[('f', 'int64'), ('d', 'int64'), ('c', 'int64')])
+        rows = rows[rows['f'] < size]
+        if len(rows) == 0: continue
+        day0 = rows['d'].min()
+        span = int(rows['d'].max() - day0) + 1
+        keys = rows['f'] * span + (rows['d'] - day0)
+        order = np.argsort(keys, kind='stable')
+        keys, counts = keys[order], rows['c'][order]
+        f, d = rows['f'][order], rows['d'][order]
+        p = parent[f]
+        pkeys = np.where(p >= 0, p * span + (d - day0), -1)
+        at = np.minimum(np.searchsorted(keys, pkeys), len(keys) - 1)
+        bad = np.flatnonzero((p >= 0) & (keys[at] == pkeys) & (counts > counts[at] + hierarchyslack))
+        if len(bad) == 0: continue
+        found += len(bad)
+        out = pd.DataFrame({'lo': rank[f[bad]], 'site': sitenames[site_int],
+            'agg_date': pd.to_datetime(d[bad], unit='D').strftime('%Y-%m-%d %H:%M:%S'), 'fullname_int': f[bad], 'parent_int': p[bad],
+            'child_count': counts[bad], 'parent_count': counts[at[bad]], 'excess': counts[bad] - counts[at[bad]]}).sort_values(['lo', 'agg_date'])
+        cur.executemany("insert into hierarchy_violations values (?,?,?,?,?,?,?,?)", out.astype('object').itertuples(index=False, name=None))
+    conn.commit()
+    cur.close()
+    print("Found %d hierarchy violations in %.1f sec" % (found, time.time() - start))
+
+# Control limits are the baseline mean +/- this many stdevs
+controlsigma = 3
+
+""" Statistics of each (fullname_int, site_int) time series in rows, a structured array with fields f, s, d (day) and c
+    (count), sorted by f, s, d. All of it is done with array operations over the series boundaries, not per series.
+    The baseline is every refresh but the last, and the last refresh breaches the control limits if it is outside the
+    baseline mean +/- controlsigma stdevs (the lower limit is at least 0). The stdev needs two baseline refreshes.
+"""
+def seriesStats(rows):
+    f, s, c = rows['f'], rows['s'], rows['c'].astype('float64')
+    new = np.ones(len(f), dtype=bool)
+    new[1:] = (f[1:] != f[:-1]) | (s[1:] != s[:-1])
+    starts = np.flatnonzero(new)
+    ends = np.append(starts[1:], len(f))
+    n = ends - starts
+    group = np.repeat(np.arange(len(starts)), n)
+    base = np.ones(len(f), dtype=bool)
+    base[ends - 1] = False
+    nbase = n - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.bincount(group[base], c[base], minlength=len(starts)) / nbase
+        mean[nbase < 1] = np.nan
+        sq = np.bincount(group[base], (c[base] - mean[group[base]]) ** 2, minlength=len(starts))
+        stdev = np.where(nbase > 1, np.sqrt(sq / (nbase - 1)), np.nan)
+        last = c[ends - 1]
+        prev = np.where(n > 1, c[np.maximum(ends - 2, starts)], np.nan)
+        delta = last - prev
+        lcl = np.maximum(mean - controlsigma * stdev, 0)
+        ucl = mean + controlsigma * stdev
+        return pd.DataFrame({'fullname_int': f[starts], 'site_int': s[starts], 'n': n, 'last_day': rows['d'][ends - 1],
+            'last_count': last, 'prev_count': prev, 'delta': delta, 'pct_change': np.where(prev > 0, delta / prev * 100, np.nan),
+            'mean': mean, 'stdev': stdev, 'lcl': lcl, 'ucl': ucl, 'breach': ((last < lcl) | (last > ucl)).astype('int64')})
+
+""" Materialize statistics of each concept's time series at each site in totalnums_trend (see seriesStats): the number
+    of refreshes, the last count and its delta and percent change from the one before, the baseline mean and stdev, the
+    control limits, and whether the last count breaches them. Suppressed counts (-1) are left out, as for site outliers.
+    Indexed for the dashboard's control bands (by concept and site) and biggest drops (by site and delta).
+    If changed_sites is given (from an incremental buildDb), only those sites' series are recomputed.
+"""
+def postProcessTrends(changed_sites=None):
+    start = time.time()
+    cur = openDb().cursor()
+    sitenames = dict(conn.execute("select site_int, site from sites").fetchall())
+    params = []
+    if changed_sites is None or not tableExists('totalnums_trend'):
+        print("Computing time series statistics...")
+        cur.execute("drop table if exists totalnums_trend")
+        cur.execute("""create table totalnums_trend (fullname_int integer, site text, n integer, last_date timestamp, last_count integer,
+            prev_count integer, delta integer, pct_change real, mean real, stdev real, lcl real, ucl real, breach integer)""")
+        sitewhere = ''
+    elif len(changed_sites) > 0:
+        print("Refreshing time series statistics for " + ','.join(sorted(changed_sites)))
+        params = sorted(s for s in sitenames if sitenames[s] in changed_sites)
+        cur.execute("delete from totalnums_trend where site in (%s)" % ','.join('?' * len(changed_sites)), sorted(changed_sites))
+        sitewhere = " and site_int in (%s)" % ','.join('?' * len(params))
+    else:
+        return
+    maxint = conn.execute("select max(fullname_int) from bigfullname").fetchone()[0] or 0
+    for lo in range(0, maxint + 1, statchunk):
+        # In primary key order, so the rows come sorted by concept, site and date
+        rows = np.fromiter(conn.execute("""select fullname_int, site_int, agg_date, agg_count from totalnums_int
+            where agg_count>-1 and fullname_int>=? and fullname_int<?%s order by fullname_int, site_int, agg_date""" % sitewhere,
+            [lo, lo + statchunk] + params), dtype=[('f', 'int64'), ('s', 'int64'), ('d', 'int64'), ('c', 'int64')])
+        if len(rows) == 0: continue
+        stat = seriesStats(rows)
+        stat['site_int'] = stat['site_int'].map(sitenames)
+        stat['last_day'] = pd.to_datetime(stat['last_day'], unit='D').dt.strftime('%Y-%m-%d %H:%M:%S')
+        # NaN is written as null
+        cur.executemany("insert into totalnums_trend values (?,?,?,?,?,?,?,?,?,?,?,?,?)", stat.astype('object').itertuples(index=False, name=None))
+    cur.execute("create index if not exists totalnums_trend_fs on totalnums_trend(fullname_int, site)")
+    cur.execute("create index if not exists totalnums_trend_sd on totalnums_trend(site, delta)")
+    conn.commit()
+    cur.close()
+    print("Time series statistics took %.1f sec" % (time.time() - start))
 
 """ SQL code that creates views and additional tables on the totalnum db for analytics
 """
-def postProcess():
+def postProcessViews():
    sql = r"""
    -- Create a pre-joined view for faster coding
     drop view if exists totalnums_recent_joined;
@@ -83,49 +481,14 @@ def postProcess():
    drop view if exists totalnums_oldcols;
    
    create view totalnums_oldcols as 
-     SELECT fullname_int, agg_date AS refresh_date, agg_count AS c, site 
-	FROM totalnums;
+     SELECT fullname_int, datetime(agg_date*86400, 'unixepoch') AS refresh_date, agg_count AS c, site 
+	FROM totalnums_int t inner join sites s on s.site_int=t.site_int;
    
-   drop view if exists totalnums_recent;
-
-   -- Set up view for most recent totalnums
-    create view totalnums_recent as 
-    select t.* from totalnums t inner join 
-    (select fullname_int, site, max(agg_date) agg_date from totalnums group by fullname_int, site) x 
-     on x.fullname_int=t.fullname_int and x.site=t.site and x.agg_date=t.agg_date;
-     
-    -- Get denominator: any pt in COVID ontology (commented out is any lab test which works better if the site has lab tests)
-    drop view if exists anal_denom;
-
-    create view anal_denom as
-    select site, agg_count denominator from totalnums_recent where fullname_int in
-    (select fullname_int from bigfullname where c_fullname='\ACT\UMLS_C0031437\SNOMED_3947185011\');--UMLS_C0022885\')
-
-    -- View total / denominator = pct
-    drop view if exists totalnums_recent_pct;
-    
-    create view totalnums_recent_pct as
-    select fullname_int, agg_date, cast(cast(agg_count as float) / denominator * 100 as int) pct, tot.site from totalnums_recent tot inner join anal_denom d on tot.site=d.site; 
-    
-    -- Site outliers: compute avg and stdev.
-    -- I materialize this (rather than a view) because SQLite doesn't have a stdev function.
-    drop table if exists outliers_sites;
-        
-    create table outliers_sites as
-    select agg_count-stdev-average,* from totalnums_recent r inner join
-    (select * from
-    (select fullname_int,avg(agg_count) average, stdev(agg_count) stdev, count(*) num_sites from totalnums_recent r  where agg_count>-1 group by fullname_int) 
-     where num_sites>1) stat on stat.fullname_int=r.fullname_int;
-     
-    -- Site outliers: compute avg and stdev.
-    -- I materialize this (rather than a view) because SQLite doesn't have a stdev function.
-    drop table if exists outliers_sites_pct;
-        
-    create table outliers_sites_pct as
-    select pct-stdev-average,* from totalnums_recent_pct r inner join
-    (select * from
-    (select fullname_int,avg(pct) average, stdev(pct) stdev, count(*) num_sites from totalnums_recent_pct r  where pct>=0 group by fullname_int) 
-     where num_sites>1) stat on stat.fullname_int=r.fullname_int;
+   -- Most recent totalnums are materialized in totalnums_recent by postProcessRecent()
+
+    -- Denominators (anal_denom) and total / denominator = pct (totalnums_recent_pct) are materialized by postProcessDenominators()
+
+    -- Site outliers (outliers_sites and outliers_sites_pct) are materialized by postProcessOutliers()
 
     -- Add some fullnames for summary measures and reporting
     drop table if exists  toplevel_fullnames;
@@ -148,64 +511,538 @@ def postProcess():
     create index toplevel_fullnames_f on toplevel_fullnames(fullname_int);
 
    """
-   cur = conn.cursor()
+   cur = openDb().cursor()
    cur.executescript(sql)
    cur.close()
 
-def buildDb():
-    # Build the main totalnums db
-    files = [f for f in listdir(basedir) if ".csv" in f[-4:]]
-    totals = []
-    # Load the files
-    for f in files:
-        print(basedir + '/' + f)
-        tot = totalnum_load(basedir + '/' + f)
-        totals.append(tot)
+""" All of the post-processing after buildDb. If changed_sites is given (from an incremental buildDb),
+    totalnums_recent, totalnums_trend, totalnums_rollup and hierarchy_violations are only refreshed for those sites.
+"""
+def postProcess(changed_sites=None):
+   postProcessRecent(changed_sites)
+   postProcessViews()
+   postProcessDenominators()
+   postProcessOutliers()
+   postProcessMissing()
+   postProcessTrends(changed_sites)
+   postProcessRollup(changed_sites)
+   postProcessHierarchy(changed_sites)
+   analyzeDb()
+   buildStamp()
+
+# Gather the index statistics the query planner uses to choose join orders (sampled, so it's quick on a big db).
+# Without them it can pick a whole-denominator scan of totalnums_pct over a lookup of one level's children.
+def analyzeDb():
+    conn.execute("PRAGMA analysis_limit=1000")
+    conn.execute("analyze")
+    conn.commit()
 
-    # 11-20 - support both utf-8 and cp1252
-    print(bigfullnamefile)
+""" Record a new build stamp in build_info. The dashboard's result cache (totalnum_cache) is keyed on it, so anything
+    cached from an earlier build of this db is dropped.
+"""
+def buildStamp():
+    cur = openDb().cursor()
+    cur.execute("create table if not exists build_info (key text primary key, value text)")
+    cur.executemany("insert or replace into build_info values (?,?)",
+        [('build_id', uuid.uuid4().hex), ('built', dt.datetime.now().strftime('%Y-%m-%d %H:%M:%S')), ('sqlite', sqlite3.sqlite_version)])
+    conn.commit()
+    cur.close()
+
+""" Manifest of every file that has been loaded into the db (the ontology file has a null site).
+    Incremental builds compare size and mtime (then the content hash) against it to find new or changed reports.
+"""
+def manifestInit():
+    cur = conn.cursor()
+    cur.execute("""create table if not exists ingest_manifest (file_id integer primary key, path text unique, size integer,
+        mtime real, hash text, site text, nrows integer, loaded_at text)""")
+    cur.close()
+
+# A zip member already has a CRC of its content, so it isn't read
+def fileHash(fname):
+    member = zipMember(fname)
+    if member:
+        with zipfile.ZipFile(member[0]) as z:
+            return 'crc32:%08x' % z.getinfo(member[1]).CRC
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# Size and mtime of a file, or of a zip member (its uncompressed size and its own timestamp)
+def fileStat(fname):
+    member = zipMember(fname)
+    if member:
+        with zipfile.ZipFile(member[0]) as z:
+            info = z.getinfo(member[1])
+        return info.file_size, time.mktime(info.date_time + (0, 0, -1))
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime
+
+# Returns (status, file_id, size, mtime, hash) where status is 'new', 'changed', or 'same'.
+# The hash is only computed when size or mtime differ from the manifest. Reports are keyed by their name within basedir.
+def manifestCheck(key, fname):
+    size, mtime = fileStat(fname)
+    row = conn.execute("select file_id, size, mtime, hash from ingest_manifest where path=?", (key,)).fetchone()
+    if row is None:
+        return 'new', None, size, mtime, fileHash(fname)
+    if row[1] == size and row[2] == mtime:
+        return 'same', row[0], size, mtime, row[3]
+    fhash = fileHash(fname)
+    if fhash == row[3]:
+        # Touched but not changed - just remember the new mtime
+        conn.execute("update ingest_manifest set mtime=? where file_id=?", (mtime, row[0]))
+        return 'same', row[0], size, mtime, fhash
+    return 'changed', row[0], size, mtime, fhash
+
+def manifestRecord(key, file_id, size, mtime, fhash, site, nrows):
+    cur = conn.cursor()
+    if file_id is None:
+        cur.execute("insert into ingest_manifest(path,size,mtime,hash,site,nrows,loaded_at) values (?,?,?,?,?,?,?)",
+                    (key, size, mtime, fhash, site, nrows, dt.datetime.now().isoformat(sep=' ', timespec='seconds')))
+        file_id = cur.lastrowid
+    else:
+        cur.execute("update ingest_manifest set size=?,mtime=?,hash=?,site=?,nrows=?,loaded_at=? where file_id=?",
+                    (size, mtime, fhash, site, nrows, dt.datetime.now().isoformat(sep=' ', timespec='seconds'), file_id))
+    cur.close()
+    return file_id
+
+def tableExists(name):
+    return conn.execute("select count(*) from sqlite_master where type in ('table','view') and name=?", (name,)).fetchone()[0] > 0
+
+# 'table', 'view', or None
+def objectType(name):
+    row = conn.execute("select type from sqlite_master where type in ('table','view') and name=?", (name,)).fetchone()
+    return row[0] if row else None
+
+# Drop a table or view, whichever it is
+def dropObject(name):
+    otype = objectType(name)
+    if otype: conn.execute("drop %s %s" % (otype, name))
+
+# Read the ontology file. 11-20 - support both utf-8 and cp1252
+def bigfullname_load(fname):
+    print(fname)
     bigfullname = None
     try:
-        bigfullname = pd.read_csv(bigfullnamefile,index_col='c_fullname',delimiter=',',dtype='str')
+        bigfullname = pd.read_csv(fname,index_col='c_fullname',delimiter=',',dtype='str')
     except UnicodeDecodeError:
-        bigfullname = pd.read_csv(bigfullnamefile,index_col='c_fullname',delimiter=',',dtype='str',encoding='cp1252')
+        bigfullname = pd.read_csv(fname,index_col='c_fullname',delimiter=',',dtype='str',encoding='cp1252')
 
-    # Add c_hlevel, domain, and fullname_int columns
+    # Add c_hlevel, domain columns
     if "c_hlevel" not in bigfullname.columns: bigfullname.insert(1, "c_hlevel", [x.count("\\") for x in bigfullname.index])
     bigfullname.insert(1, "domain", [x.split('\\')[2] if "PCORI_MOD" not in x else "MODIFIER" for x in bigfullname.index])
-    bigfullname['fullname_int']=range(0,len(bigfullname))
+    return bigfullname
+
+""" Write bigfullname. In incremental mode, paths that are already in the db keep their fullname_int (so totalnums and
+    anything materialized from it stay valid) and new paths are numbered after the current max. Paths that have dropped
+    out of the ontology file are kept, because totalnums may still reference them.
+"""
+def bigfullname_write(bigfullname, incremental=False):
+    cur = conn.cursor()
+    if incremental and tableExists('bigfullname'):
+        old = pd.read_sql("select * from bigfullname", conn, index_col='c_fullname')
+        # A path can be in bigfullname more than once. Every row of a path gets the fullname_int that its reports were
+        # loaded with (the first, which is the smallest), and a new path gets one new fullname_int for all its rows.
+        oldints = old[~old.index.duplicated()]['fullname_int']
+        bigfullname['fullname_int'] = oldints.reindex(bigfullname.index).to_numpy()
+        newpaths = bigfullname.index[bigfullname['fullname_int'].isna()].unique()
+        start = int(old['fullname_int'].max()) + 1 if len(old) > 0 else 0
+        newints = pd.Series(range(start, start + len(newpaths)), index=newpaths, dtype='int64')
+        ints = bigfullname['fullname_int'].to_numpy()
+        bigfullname['fullname_int'] = np.where(np.isnan(ints), newints.reindex(bigfullname.index).to_numpy(dtype='float64'), ints).astype('int64')
+        bigfullname = pd.concat([bigfullname, old[~old.index.isin(bigfullname.index)]])
+        print("Ontology: %d new paths" % len(newpaths))
+    else:
+        bigfullname['fullname_int']=range(0,len(bigfullname))
+    # Written in pre-order, so reading the tree in order (e.g., the dashboard's OntologyTree) is a sequential scan
+    bigfullname = hierarchyIndex(bigfullname).sort_values(['lo','fullname_int'], kind='stable')
     bigfullname.to_sql('bigfullname',conn,if_exists='replace')
+    cur.execute("CREATE INDEX bfn_0 on bigfullname(c_hlevel)")
+    cur.execute("CREATE INDEX bfn_int on bigfullname(fullname_int)")
+    cur.execute("CREATE INDEX bfn_parent on bigfullname(parent_int)")
+    cur.execute("CREATE INDEX bfn_lo on bigfullname(lo)")
+    # Children adjacency, clustered by parent (roots are under -1)
+    cur.execute("drop table if exists bigfullname_children")
+    cur.execute("create table bigfullname_children (parent_int integer, child_int integer, primary key (parent_int, child_int)) without rowid")
+    cur.execute("insert into bigfullname_children select distinct parent_int, fullname_int from bigfullname")
+    # The rollup is clustered by parent and the hierarchy violations by pre-order rank, so a new hierarchy means a full
+    # rebuild of them (in postProcessRollup and postProcessHierarchy)
+    cur.execute("drop table if exists totalnums_rollup")
+    cur.execute("drop table if exists hierarchy_violations")
+    cur.close()
+    searchIndex()
+    return bigfullname
 
-    print("Converting path to int...")
-    # Shrink the frame (remove c_name and fullname and hlevel and domain and add just the fullname_int)
-    #outdf = delish.join(bigfullname,rsuffix='_bf',how='inner').reset_index()[['fullname_int','refresh_date','site','c']]
-    outdf = pd.DataFrame()
-    for t in totals:
-        outdf=outdf.append(t)
-    outdf=outdf.join(bigfullname,on='c_fullname',rsuffix='_bf',how='inner').reset_index()[['fullname_int','agg_date','agg_count','site']]
-    print("Writing totalnum SQL...")
-    # Temp step - use old style column names for compatibility
-    #outdf=outdf.rename(columns={'agg_date':'refresh_date','agg_count':'c'})
-    outdf.to_sql("totalnums",conn,if_exists='replace', index=False)
+""" Full-text index (bigfullname_fts) over c_name, c_fullname and c_tooltip for the dashboard's concept search. Paths
+    are tokenized on the backslashes, so any segment can be matched, and 2 and 3 character prefixes are indexed for
+    search-as-you-type. Needs SQLite with FTS5; without it, the dashboard falls back to a LIKE search on c_name.
+"""
+def searchIndex():
+    cur = conn.cursor()
+    try:
+        cur.execute("drop table if exists bigfullname_fts")
+        cur.execute("""create virtual table bigfullname_fts using fts5(c_name, c_fullname, c_tooltip, fullname_int unindexed,
+            tokenize='unicode61 remove_diacritics 2', prefix='2 3')""")
+    except sqlite3.OperationalError as e:
+        print("Skipping the search index, SQLite has no FTS5: " + str(e))
+        return
+    columns = [r[1] for r in cur.execute("pragma table_info(bigfullname)")]
+    cur.execute("insert into bigfullname_fts select c_name, c_fullname, %s, fullname_int from bigfullname" % ('c_tooltip' if 'c_tooltip' in columns else 'null'))
+    cur.execute("insert into bigfullname_fts(bigfullname_fts) values('optimize')")
+    cur.close()
+
+""" Hierarchy index for bigfullname (indexed by c_fullname, with fullname_int assigned):
+    parent_int - fullname_int of the nearest ancestor path that is in bigfullname (-1 for roots). This is not always the
+      path minus its last segment, because ACT paths contain version segments that are not nodes themselves.
+    lo, hi - pre-order interval. lo is the node's rank in sorted path order and hi the highest rank in its subtree, so the
+      descendants of a node are exactly the nodes with lo between its lo+1 and hi.
+    Sorted order works as a pre-order because every path that starts with a given path sorts right after it.
+"""
+def hierarchyIndex(bigfullname):
+    fullname_ints = bigfullname['fullname_int']
+    fullname_ints = fullname_ints[~fullname_ints.index.duplicated()]
+    paths = sorted(fullname_ints.index)
+    ints = fullname_ints.reindex(paths).to_numpy()
+    n = len(paths)
+    parent = np.full(n, -1, dtype='int64')
+    hi = np.arange(n, dtype='int64')
+    stack = [] # Ranks of the ancestors of the current path
+    for rank, path in enumerate(paths):
+        while stack and not path.startswith(paths[stack[-1]]):
+            hi[stack.pop()] = rank - 1
+        if stack:
+            parent[rank] = ints[stack[-1]]
+        stack.append(rank)
+    for rank in stack:
+        hi[rank] = n - 1
+    index = pd.DataFrame({'parent_int': parent, 'lo': np.arange(n, dtype='int64'), 'hi': hi}, index=paths)
+    return bigfullname.drop(columns=['parent_int','lo','hi'], errors='ignore').join(index)
+
+# 64-bit hashes of c_fullnames (an array or Index of str, may have nulls, which hash as an empty path)
+def pathHashes(paths):
+    p = np.asarray(paths, dtype=object)
+    return pd.util.hash_array(np.where(pd.isna(p), '', p).astype(object), categorize=False)
+
+""" 64-bit keys of c_fullnames after normalizing away differences that reports have from the ontology: surrounding
+    whitespace, a missing leading or trailing backslash, case, and Unicode normalization form.
+"""
+def pathKeys(paths):
+    p = pd.Series(np.asarray(paths, dtype=object)).fillna('')
+    return pathHashes('\\' + p.str.normalize('NFC').str.strip().str.strip('\\').str.upper() + '\\')
+
+# Sorted keys and their fullname_ints, keeping the first of any duplicate keys. Returns the number of duplicates too.
+def keyIndex(keys, ints):
+    order = np.argsort(keys, kind='stable')
+    keys, ints = keys[order], ints[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = keys[1:] != keys[:-1]
+    return (keys[first], ints[first]), int((~first).sum())
+
+""" The path lookup used to map report paths to fullname_int, from a Series of fullname_int indexed by c_fullname: the
+    sorted hashes of the ontology's paths as they are, and of their normalized keys (pathKeys), with the fullname_ints.
+    Plain arrays (32 bytes per path) are cheap to send to worker processes, unlike the Series. Most report paths match
+    exactly, so only the rest are normalized. Paths that only differ by normalization keep the first one.
+"""
+def pathLookup(fullname_ints):
+    ints = fullname_ints.to_numpy(dtype='int64')
+    exact, _ = keyIndex(pathHashes(fullname_ints.index), ints)
+    normalized, dups = keyIndex(pathKeys(fullname_ints.index), ints)
+    if dups > 0: print("%d ontology paths are duplicates of another after normalization" % dups)
+    return exact, normalized
+
+# fullname_int of each key in a keyIndex (-1 if it is not there)
+def findKeys(index, k):
+    keys, ints = index
+    if len(keys) == 0: return np.full(len(k), -1, dtype='int64')
+    at = np.minimum(np.searchsorted(keys, k), len(keys) - 1)
+    return np.where(keys[at] == k, ints[at], -1)
+
+# fullname_int of each path in a pathLookup (-1 if it is not in the ontology)
+def lookupPaths(lookup, paths):
+    exact, normalized = lookup
+    paths = np.asarray(paths, dtype=object)
+    ints = findKeys(exact, pathHashes(paths))
+    miss = np.flatnonzero(ints < 0)
+    if len(miss) > 0:
+        ints[miss] = findKeys(normalized, pathKeys(paths[miss]))
+    return ints
+
+# The path lookup for totalnum_parse, set by buildDb (and in each worker process by the pool initializer)
+pathlookup = None
+
+def setPathLookup(lookup):
+    global pathlookup
+    pathlookup = lookup
+
+""" Parse and normalize a report in chunks of compact typed arrays, so it is cheap to send back from a worker process:
+    fullname_ints - int64 per row, mapped through pathlookup (-1 if the path is null or not in the ontology),
+    unmatched - the distinct paths not in the ontology (not null) and their row counts, dates - datetime64 per row,
+    counts - numeric per row, site - the site id from the file name.
+"""
+def totalnum_parse(fname, encoding=None):
+    site = fname_site(fname)
+    for df in totalnum_chunks(fname, encoding):
+        codes, paths = pd.factorize(df['c_fullname'])
+        ints = np.append(lookupPaths(pathlookup, paths), -1)
+        missed = np.flatnonzero(ints[:-1] < 0)
+        rows = np.bincount(codes[codes >= 0], minlength=len(paths))
+        yield {'site': site, 'fullname_ints': ints[codes], 'unmatched': (np.asarray(paths, dtype=object)[missed], rows[missed]),
+               'dates': df['agg_date'].to_numpy(), 'counts': df['agg_count'].to_numpy(), 'nrows': len(df)}
+
+# Worker version of totalnum_parse - returns all of a file's chunks. Support both utf-8 and cp1252
+def totalnum_parse_file(fname):
+    try:
+        return list(totalnum_parse(fname))
+    except UnicodeDecodeError:
+        return list(totalnum_parse(fname, 'cp1252'))
+
+""" Parse reports in file order, in worker processes if jobs>1. Results come back in the same order either way.
+    Only a few files are in flight at once, so memory does not grow with the number of reports.
+"""
+def totalnum_parse_all(fnames, jobs=1):
+    if jobs > 1 and len(fnames) > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=setPathLookup, initargs=(pathlookup,)) as pool:
+            pending = deque()
+            for fname in fnames:
+                pending.append(pool.submit(totalnum_parse_file, fname))
+                if len(pending) >= jobs * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    else:
+        for fname in fnames:
+            yield totalnum_parse(fname)
+
+""" Bulk insert parsed chunks into totalnums_int (dropping rows whose path is not in the ontology, or with no date), and
+    record the paths that are not in the ontology, with their row counts, in ingest_unmatched. Dates are stored as days
+    since 1970-01-01. If a report repeats a concept and date, the last row wins. Returns the number of rows read and the
+    number of them whose path was not in the ontology.
+"""
+def totalnum_write(chunks, site, site_int, file_id, progress):
+    nrows = 0
+    unmatched = {}
+    for parsed in chunks:
+        fi = parsed['fullname_ints']
+        days = parsed['dates'].astype('datetime64[D]')
+        keep = (fi >= 0) & ~np.isnat(days)
+        fi = fi[keep]
+        days = days[keep].astype('int64')
+        counts = pd.Series(parsed['counts'][keep]).astype('object').where(lambda c: c.notna(), None).to_numpy()
+        # Insert in key order, which is much faster for the clustered table
+        order = np.lexsort((days, fi))
+        conn.executemany("insert or replace into totalnums_int(fullname_int,site_int,agg_date,agg_count,file_id) values (?,?,?,?,?)",
+                         zip(fi[order].tolist(), repeat(site_int), days[order].tolist(), counts[order].tolist(), repeat(file_id)))
+        for path, n in zip(*parsed['unmatched']):
+            unmatched[path] = unmatched.get(path, 0) + int(n)
+        nrows += parsed['nrows']
+        progress(len(fi))
+    conn.executemany("insert into ingest_unmatched values (?,?,?,?)", ((file_id, site, path, n) for path, n in unmatched.items()))
+    return nrows, sum(unmatched.values())
 
+# Site dimension: site_int for a site id, adding it if needed
+def siteInt(site):
+    row = conn.execute("select site_int from sites where site=?", (site,)).fetchone()
+    if row: return row[0]
+    return conn.execute("insert into sites(site) values (?)", (site,)).lastrowid
 
+""" Build (or with incremental=True, update) the main totalnums db.
+    Incremental mode only loads reports that are new or changed since they were recorded in ingest_manifest, and replaces
+    the rows of a changed report. If the ontology changed, the reports with paths that were not in the old one (see
+    ingest_unmatched) are reloaded too. If a report was removed, its site's rows are deleted and the site's remaining
+    reports reloaded. Returns the set of sites whose data changed.
+    Reports are streamed into totalnums_int in chunks inside one transaction, so memory stays flat however many there are.
+    totalnums_int is the compact storage: sites are stored as site_int (see the sites table) and dates as a day number,
+    clustered by (fullname_int, site_int, agg_date). The totalnums view has the original columns.
+"""
+def buildDb(incremental=False, jobs=1):
+    openDb()
+    # Bulk load settings. A failed full build is just rerun, so it can skip the journal entirely, but an incremental one
+    # must be able to roll back (set explicitly, since the connection may have done a full build before)
+    conn.execute("PRAGMA cache_size=-262144")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA synchronous=%s" % ('NORMAL' if incremental else 'OFF'))
+    conn.execute("PRAGMA journal_mode=%s" % ('DELETE' if incremental else 'OFF'))
+    if incremental and not (tableExists('totalnums_int') and tableExists('bigfullname') and tableExists('ingest_manifest')):
+        print("No existing db to update, doing a full build")
+        incremental = False
+    if not incremental:
+        conn.execute("drop table if exists ingest_manifest")
+        conn.execute("drop table if exists ingest_unmatched")
+    manifestInit()
+
+    # The ontology is only reloaded if the file changed
+    status, file_id, size, mtime, fhash = manifestCheck(os.path.abspath(bigfullnamefile), bigfullnamefile)
+    reload = set()
+    if status == 'same' and incremental:
+        print("Ontology unchanged")
+        bigfullname = pd.read_sql("select c_fullname, fullname_int from bigfullname", conn, index_col='c_fullname')
+        if not tableExists('bigfullname_fts'): searchIndex() # Dbs built before there was one
+    else:
+        bigfullname = bigfullname_write(bigfullname_load(bigfullnamefile), incremental)
+        manifestRecord(os.path.abspath(bigfullnamefile), file_id, size, mtime, fhash, None, len(bigfullname))
+        # Rows of unchanged reports whose paths were not in the old ontology may be in the new one, so those reports are
+        # reloaded, as a full build would (all of them, for dbs from before unmatched paths were recorded)
+        if incremental:
+            reload = set(r[0] for r in conn.execute("select distinct m.path from ingest_unmatched u inner join ingest_manifest m on m.file_id=u.file_id")) \
+                if tableExists('ingest_unmatched') else None
+    fullname_ints = bigfullname['fullname_int']
+    setPathLookup(pathLookup(fullname_ints[~fullname_ints.index.duplicated()]))
+
+    # Find the files to load
+    files = reportFiles(basedir)
+    resites = set()
+    if incremental:
+        # Reports removed since the last build. A later report's rows replace an earlier one's, so the rest of their sites'
+        # reports are reloaded in order, as a full build would, and sites with no reports left are dropped.
+        present = set(files)
+        removed = [(f, site) for f, site in conn.execute("select path, site from ingest_manifest where site is not null") if f not in present]
+        resites = set(site for f, site in removed)
+        if resites:
+            for f, site in removed: print(basedir + '/' + f + ' (removed)')
+            sites = sorted(resites)
+            marks = ','.join('?' * len(sites))
+            conn.execute("delete from totalnums_int where site_int in (select site_int from sites where site in (%s))" % marks, sites)
+            if tableExists('ingest_unmatched'): conn.execute("delete from ingest_unmatched where site in (%s)" % marks, sites)
+            conn.executemany("delete from ingest_manifest where path=?", ((f,) for f, site in removed))
+            left = set(fname_site(basedir + '/' + f) for f in files)
+            conn.executemany("delete from sites where site=?", ((site,) for site in sites if site not in left))
+    toload = []
+    for f in files:
+        fname = basedir + '/' + f
+        status, file_id, size, mtime, fhash = manifestCheck(f, fname)
+        if status == 'same':
+            if fname_site(fname) not in resites and reload is not None and f not in reload:
+                continue
+            status = 'reload'
+        print(fname + {'new': '', 'changed': ' (changed)', 'reload': ' (reloaded)'}[status])
+        toload.append((f, fname, status, file_id, size, mtime, fhash))
 
-    # Add indexes
-    print("Indexing...")
+    # Load the files (parsing in parallel if jobs>1), converting path to int
+    print("Writing totalnum SQL...")
     cur = conn.cursor()
-    cur.execute("CREATE INDEX bfn_0 on bigfullname(c_hlevel)")
-    cur.execute("CREATE INDEX bfn_int on bigfullname(fullname_int)")
-    cur.execute("CREATE INDEX tot_int on totalnums(fullname_int)")
+    if not incremental:
+        dropObject('totalnums') # A table in older dbs
+        cur.execute("drop table if exists totalnums_int")
+        cur.execute("drop table if exists sites")
+    cur.execute("create table if not exists sites (site_int integer primary key, site text unique)")
+    cur.execute("""create table if not exists totalnums_int (fullname_int integer, site_int integer, agg_date integer, agg_count integer,
+        file_id integer, primary key (fullname_int, site_int, agg_date)) without rowid""")
+    # A report only has one site, so its rows are found (for replacement) through the site index rather than a file_id index
+    cur.execute("CREATE INDEX if not exists tot_site on totalnums_int(site_int)")
+    # Compatibility view with the original totalnums columns
+    cur.execute("""create view if not exists totalnums as
+        select fullname_int, datetime(agg_date*86400, 'unixepoch') agg_date, agg_count, site, file_id
+        from totalnums_int t inner join sites s on s.site_int=t.site_int""")
+    start = time.time()
+    written = [0, start]
+    # Report rows/sec every few seconds
+    def progress(n):
+        written[0] += n
+        if time.time() - written[1] > 5:
+            written[1] = time.time()
+            print("  %d rows, %d rows/sec" % (written[0], written[0] / (written[1] - start)))
 
-    print("Done!")
+    # Report paths that are not in the ontology (after normalization), with their row counts, per report file
+    cur.execute("""create table if not exists ingest_unmatched (file_id integer, site text, c_fullname text, nrows integer,
+        primary key (file_id, c_fullname)) without rowid""")
+
+    changed_sites = set(resites)
+    unmatched = {}
+    for (f, fname, status, file_id, size, mtime, fhash), chunks in zip(toload, totalnum_parse_all([x[1] for x in toload], jobs)):
+        site = fname_site(fname)
+        site_int = siteInt(site)
+        if status in ('changed', 'reload'):
+            cur.execute("delete from totalnums_int where site_int=? and file_id=?", (site_int, file_id))
+            cur.execute("delete from ingest_unmatched where file_id=?", (file_id,))
+        file_id = manifestRecord(f, file_id, size, mtime, fhash, site, None)
+        try:
+            nrows, nunmatched = totalnum_write(chunks, site, site_int, file_id, progress)
+        except UnicodeDecodeError:
+            # Support both utf-8 and cp1252 - start the file over
+            cur.execute("delete from totalnums_int where site_int=? and file_id=?", (site_int, file_id))
+            cur.execute("delete from ingest_unmatched where file_id=?", (file_id,))
+            nrows, nunmatched = totalnum_write(totalnum_parse(fname, 'cp1252'), site, site_int, file_id, progress)
+        cur.execute("update ingest_manifest set nrows=? where file_id=?", (nrows, file_id))
+        changed_sites.add(site)
+        unmatched[site] = unmatched.get(site, 0) + nunmatched
+    conn.commit()
+    print("Wrote %d rows in %.1f sec (%d rows/sec)" % (written[0], time.time() - start, written[0] / max(time.time() - start, 1e-6)))
+    for site, n in sorted(unmatched.items()):
+        if n > 0: print("  %s: %d rows with paths not in the ontology (see ingest_unmatched)" % (site, n))
+    cur.close()
+
+    print("Done! %d files loaded, sites changed: %s" % (len(toload), ','.join(sorted(changed_sites))))
+    return changed_sites
+
+# Number of report rows read at a time
+chunksize = 250000
 
 def totalnum_load(fname="",df=None):
-    if not df:
+    if df is None:
         # Support both utf-8 and cp1252
         try:
-            df = pd.read_csv(fname,index_col=0)
+            return pd.concat(totalnum_chunks(fname))
         except UnicodeDecodeError:
-            df = pd.read_csv(fname, index_col=0,encoding='cp1252')
+            return pd.concat(totalnum_chunks(fname, 'cp1252'))
+    return totalnum_normalize(df, fname)
+
+# Read a report in chunks of normalized rows (decompressing it as it is read, see openReport)
+def totalnum_chunks(fname, encoding=None):
+    with openReport(fname) as f, pd.read_csv(f, index_col=0, encoding=encoding, chunksize=chunksize) as reader:
+        for df in reader:
+            yield totalnum_normalize(df, fname)
+
+# Compressed reports, by extension, and how to open them for reading. .zst needs the zstandard package.
+def zstdOpen(fname, mode):
+    import zstandard
+    return zstandard.open(fname, mode)
+
+compressions = {'.gz': gzip.open, '.bz2': bz2.open, '.zst': zstdOpen}
+
+def zstdAvailable():
+    try:
+        import zstandard
+        return True
+    except ImportError:
+        return False
+
+""" The reports in a directory, as names within it (which are also their ingest_manifest keys): report .csv files,
+    compressed ones (.csv.gz, .csv.bz2, and .csv.zst if zstandard is installed), and the .csv members of .zip
+    bundles, named bundle.zip/member.csv.
+"""
+def reportFiles(dirname):
+    files = []
+    for f in sorted(listdir(dirname)):
+        lower = f.lower()
+        if lower.endswith('.zip'):
+            with zipfile.ZipFile(dirname + '/' + f) as z:
+                files += [f + '/' + m for m in sorted(z.namelist()) if m.lower().endswith('.csv')]
+        elif lower.endswith('.csv.zst') and not zstdAvailable():
+            print("Skipping %s, reading .zst needs the zstandard package" % f)
+        elif lower.endswith('.csv') or any(lower.endswith('.csv' + ext) for ext in compressions):
+            files.append(f)
+    return files
+
+# (archive, member) of a report in a zip bundle (as named by reportFiles), or None
+def zipMember(fname):
+    at = fname.lower().find('.zip/')
+    return (fname[:at + 4], fname[at + 5:]) if at >= 0 else None
+
+""" Open a report for reading in binary: a plain file, a compressed one, or a member of a zip bundle (see reportFiles).
+    It is decompressed as it is read, so nothing is written to disk.
+"""
+@contextmanager
+def openReport(fname):
+    member = zipMember(fname)
+    if member:
+        with zipfile.ZipFile(member[0]) as z, z.open(member[1]) as f:
+            yield f
+    else:
+        with compressions.get(os.path.splitext(fname)[1].lower(), open)(fname, 'rb') as f:
+            yield f
+
+def totalnum_normalize(df, fname):
     # Remove null rows
     #df = df.loc[(df.ix[:,3:]!=0).any(axis=1)]
     # Lowercase totalnum columns
@@ -216,17 +1053,44 @@ def totalnum_load(fname="",df=None):
     df = pd.concat([df.iloc[:,0:2],(df.iloc[:,2:].apply(pd.to_numeric,errors="coerce"))],axis=1)
     # And convert date string to datetime
     df = pd.concat([df.iloc[:, 0:1], pd.to_datetime(df['agg_date']),df.iloc[:,2]], axis=1)
-    # Get site id out of report_siteid_blah.csv
+    df['site']=fname_site(fname)
+
+    return df
+
+# Get site id out of report_siteid_blah.csv (or .csv.gz, etc., or bundle.zip/report_siteid_blah.csv)
+def fname_site(fname):
     rfn = fname[::-1]
     fname_only = rfn[0:rfn.index('/')][::-1]
     fns = fname_only[fname_only.index('_')+1:]
     fns = fns[0:fns.index('_')]
-    df['site']=fns
-
-    return df
+    return fns
 
 if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Load report_[siteid]_[foo].csv totalnum reports into a SQLite db")
+    parser.add_argument('--basedir', default=basedir, help="Directory with the reports; the db is written here as totalnums.db")
+    parser.add_argument('--ontology', default=bigfullnamefile, help="CSV of all possible paths (c_fullname, c_name, ...)")
+    parser.add_argument('--incremental', action='store_true', help="Only load new or changed reports, as tracked in ingest_manifest")
+    parser.add_argument('--jobs', type=int, default=1, help="Number of worker processes used to parse reports")
+    parser.add_argument('--compare-stats', action='store_true', help="Just time the old SQL outlier statistics against the pandas version")
+    parser.add_argument('--cubedir', default=None, help="Where to write the columnar cube (see totalnum_cube), default totalnums_cube in basedir")
+    parser.add_argument('--no-cube', action='store_true', help="Don't write the columnar cube")
+    parser.add_argument('--denominator', action='append', metavar='NAME=C_FULLNAME',
+                        help="A denominator concept for the percent tables (repeat for more, the first is the default). Default: the db's current ones, or " + ', '.join(denominators))
+    args = parser.parse_args()
+    basedir = args.basedir
+    bigfullnamefile = args.ontology
+    if args.denominator:
+        denominators = dict(d.split('=', 1) for d in args.denominator)
+
     print("SQLite Version is:", sqlite3.sqlite_version)
-    buildDb()
-    postProcess()
-    None
\ No newline at end of file
+    openDb()
+    # Without --denominator, keep the denominators the db was last built with
+    if not args.denominator and tableExists('denominators'):
+        denominators = dict(conn.execute("select denom, c_fullname from denominators order by ord").fetchall()) or denominators
+    if args.compare_stats:
+        compareOutlierStats()
+        exit()
+    changed_sites = buildDb(incremental=args.incremental, jobs=args.jobs)
+    postProcess(changed_sites if args.incremental else None)
+    if not args.no_cube:
+        totalnum_cube.writeCube(conn, args.cubedir if args.cubedir else basedir + '/totalnums_cube')
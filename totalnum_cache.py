@@ -0,0 +1,135 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+"""
+Query result cache for the dashboard. Results (usually DataFrames) are kept in a bounded LRU in memory and, optionally,
+in a directory on disk that gunicorn workers share, so a level that any worker has shown is cheap for all of them.
+
+Entries are invalidated by the db's build stamp (build_info.build_id, written by totalnum_builddb_v2): when it changes,
+the memory cache is cleared, and disk entries from other builds are no longer read (they age out of the disk cache).
+Callers must not modify a result they get from the cache, since the next caller gets the same object.
+"""
+
+# Approximate size of a cached value in bytes
+def resultSize(value):
+    if hasattr(value, 'memory_usage'):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+""" maxbytes bounds the memory cache, diskdir (optional) is the shared disk cache and diskbytes bounds it.
+    stampfn returns the current build stamp; it is checked at most every stampcheck seconds.
+"""
+class ResultCache:
+    def __init__(self, maxbytes=256 * 1024 ** 2, diskdir=None, diskbytes=2 * 1024 ** 3, stampfn=None, stampcheck=5):
+        self.maxbytes = maxbytes
+        self.diskdir = diskdir
+        self.diskbytes = diskbytes
+        self.stampfn = stampfn
+        self.stampcheck = stampcheck
+        self.entries = OrderedDict()  # key -> (value, size), least recently used first
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.stamp = None
+        self.stamped = 0
+        self.diskwrites = 0
+        self.hits = self.diskhits = self.misses = self.evictions = 0
+        if diskdir: os.makedirs(diskdir, exist_ok=True)
+
+    # Current build stamp, clearing the memory cache if it changed since the last check
+    def currentStamp(self):
+        if self.stampfn is None: return ''
+        if time.time() - self.stamped > self.stampcheck:
+            stamp = str(self.stampfn())
+            self.stamped = time.time()
+            if stamp != self.stamp:
+                with self.lock:
+                    self.entries.clear()
+                    self.bytes = 0
+                self.stamp = stamp
+        return self.stamp
+
+    def diskPath(self, stamp, key):
+        return os.path.join(self.diskdir, hashlib.sha1((stamp + '\0' + key).encode('utf-8')).hexdigest() + '.pkl')
+
+    # The cached value for key (a string, e.g., SQL), or compute() it and cache that
+    def get(self, key, compute):
+        stamp = self.currentStamp()
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+        if self.diskdir:
+            try:
+                with open(self.diskPath(stamp, key), 'rb') as f:
+                    value = pickle.load(f)
+                with self.lock:
+                    self.diskhits += 1
+                self.put(key, value)
+                return value
+            except (OSError, EOFError, pickle.UnpicklingError):
+                pass
+        with self.lock:
+            self.misses += 1
+        value = compute()
+        self.put(key, value)
+        if self.diskdir: self.diskPut(stamp, key, value)
+        return value
+
+    # Add to the memory cache, evicting the least recently used entries to stay under maxbytes
+    def put(self, key, value):
+        size = resultSize(value)
+        if size > self.maxbytes: return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.maxbytes:
+                self.bytes -= self.entries.popitem(last=False)[1][1]
+                self.evictions += 1
+
+    # Write to the disk cache (atomically, since other workers read it), and now and then trim it to diskbytes
+    def diskPut(self, stamp, key, value):
+        path = self.diskPath(stamp, key)
+        tmp = '%s.%d.%d' % (path, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        self.diskwrites += 1
+        if self.diskwrites % 100 == 1: self.diskTrim()
+
+    # Delete the oldest disk entries over diskbytes
+    def diskTrim(self):
+        files = []
+        for e in os.scandir(self.diskdir):
+            try:
+                st = e.stat()
+                files.append((st.st_mtime, st.st_size, e.path))
+            except OSError:
+                pass
+        total = sum(f[1] for f in files)
+        for mtime, size, path in sorted(files):
+            if total <= self.diskbytes: break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    # Hit and miss counters
+    def stats(self):
+        return {'hits': self.hits, 'disk_hits': self.diskhits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'bytes': self.bytes, 'maxbytes': self.maxbytes, 'stamp': self.stamp}
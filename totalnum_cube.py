@@ -0,0 +1,155 @@
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+"""
+Columnar export of a totalnums db (built by totalnum_builddb_v2), and a loader that opens it zero-copy with numpy memmaps.
+
+Rows are concepts in hierarchy pre-order (bigfullname.lo), so the descendants of a node are a contiguous block of rows
+and a subtree is sliced without copying. Columns are sites, in site_int order. The cube directory contains:
+  fullname_int.npy - int64 [rows], the fullname_int of each row
+  lo.npy - int64 [rows], the pre-order rank of each row (ascending)
+  row_of.npy - int64 [max fullname_int + 1], row of each fullname_int (-1 if none)
+  recent.npy - float32 [rows x sites], most recent count per concept and site (NaN if the site never reported it)
+  series_ptr.npy - int64 [rows + 1], and series_site.npy, series_day.npy, series_count.npy - the full time series,
+    stored ragged (CSR-style): row r's refreshes are positions series_ptr[r]:series_ptr[r+1], sorted by site then date.
+    A dense concept x site x refresh cube of the full ACT ontology would be tens of GB, so cube() densifies a slice.
+  meta.json - sites, site_ints, days (all refresh dates as days since 1970-01-01), build time
+
+To load: cube = TotalnumCube('/path/to/totalnums_cube')
+"""
+
+# Rows read from SQLite at a time while writing
+cubechunk = 500000
+
+""" Write the cube for an open totalnums db connection. It is written next to cubedir and then swapped in, so
+    a reader never sees a partial cube.
+"""
+def writeCube(conn, cubedir):
+    start = time.time()
+    newdir = cubedir + '.new'
+    shutil.rmtree(newdir, ignore_errors=True)
+    os.makedirs(newdir)
+
+    # Rows in pre-order
+    nodes = np.array(conn.execute("select fullname_int, lo from bigfullname order by lo, fullname_int").fetchall(), dtype='int64').reshape(-1, 2)
+    fullname_int, lo = nodes[:, 0], nodes[:, 1]
+    nrows = len(fullname_int)
+    row_of = np.full(int(fullname_int.max()) + 1 if nrows else 0, -1, dtype='int64')
+    row_of[fullname_int] = np.arange(nrows)
+    np.save(newdir + '/fullname_int.npy', fullname_int)
+    np.save(newdir + '/lo.npy', lo)
+    np.save(newdir + '/row_of.npy', row_of)
+
+    # Columns in site_int order
+    sites = conn.execute("select site_int, site from sites order by site_int").fetchall()
+    site_ints = np.array([s[0] for s in sites], dtype='int64')
+    col_of = np.full(int(site_ints.max()) + 1 if len(sites) else 0, -1, dtype='int64')
+    col_of[site_ints] = np.arange(len(sites))
+
+    # Recent counts
+    recent = np.lib.format.open_memmap(newdir + '/recent.npy', mode='w+', dtype='float32', shape=(nrows, len(sites)))
+    recent[:] = np.nan
+    cur = conn.execute("select r.fullname_int, s.site_int, r.agg_count from totalnums_recent r inner join sites s on s.site=r.site")
+    for chunk in iter(lambda: cur.fetchmany(cubechunk), []):
+        a = np.array(chunk, dtype='float64')
+        recent[row_of[a[:, 0].astype('int64')], col_of[a[:, 1].astype('int64')]] = a[:, 2]
+    recent.flush()
+    del recent
+
+    # Time series - first count each row's refreshes to lay out the offsets, then fill them in
+    counts = np.zeros(nrows, dtype='int64')
+    for fi, n in conn.execute("select fullname_int, count(*) from totalnums_int group by fullname_int"):
+        if fi < len(row_of) and row_of[fi] >= 0: counts[row_of[fi]] = n
+    ptr = np.zeros(nrows + 1, dtype='int64')
+    np.cumsum(counts, out=ptr[1:])
+    np.save(newdir + '/series_ptr.npy', ptr)
+    total = int(ptr[-1])
+    series_site = np.lib.format.open_memmap(newdir + '/series_site.npy', mode='w+', dtype='int32', shape=(total,))
+    series_day = np.lib.format.open_memmap(newdir + '/series_day.npy', mode='w+', dtype='int32', shape=(total,))
+    series_count = np.lib.format.open_memmap(newdir + '/series_count.npy', mode='w+', dtype='float32', shape=(total,))
+    filled = np.zeros(nrows, dtype='int64')
+    days = set()
+    # totalnums_int is clustered by (fullname_int, site_int, agg_date), so each row's refreshes come back sorted
+    cur = conn.execute("select fullname_int, site_int, agg_date, agg_count from totalnums_int")
+    for chunk in iter(lambda: cur.fetchmany(cubechunk), []):
+        a = np.array(chunk, dtype='float64')
+        fi = a[:, 0].astype('int64')
+        ok = fi < len(row_of)
+        rows = np.where(ok, row_of[np.where(ok, fi, 0)], -1)
+        a, rows = a[rows >= 0], rows[rows >= 0]
+        # Position of each record within its row: rows are in runs, so it is the offset from the start of the run
+        starts = np.r_[0, np.flatnonzero(np.diff(rows)) + 1]
+        runlen = np.diff(np.r_[starts, len(rows)])
+        within = np.arange(len(rows)) - np.repeat(starts, runlen)
+        pos = ptr[rows] + filled[rows] + within
+        np.add.at(filled, rows[starts], runlen)
+        series_site[pos] = col_of[a[:, 1].astype('int64')]
+        series_day[pos] = a[:, 2]
+        series_count[pos] = a[:, 3]
+        days.update(np.unique(a[:, 2]).astype('int64').tolist())
+    for m in (series_site, series_day, series_count):
+        m.flush()
+    del series_site, series_day, series_count
+
+    with open(newdir + '/meta.json', 'w') as f:
+        json.dump({'sites': [s[1] for s in sites], 'site_ints': site_ints.tolist(), 'days': sorted(days),
+                   'rows': nrows, 'built': time.strftime('%Y-%m-%d %H:%M:%S')}, f)
+
+    # Swap in the new cube
+    olddir = cubedir + '.old'
+    shutil.rmtree(olddir, ignore_errors=True)
+    if os.path.exists(cubedir): os.rename(cubedir, olddir)
+    os.rename(newdir, cubedir)
+    shutil.rmtree(olddir, ignore_errors=True)
+    print("Wrote cube to %s: %d concepts x %d sites, %d refreshes in %.1f sec" % (cubedir, nrows, len(sites), total, time.time() - start))
+
+""" Read-only view of a cube directory. Arrays are memory-mapped, so opening is instant and slices of rows are views
+    onto the OS page cache rather than copies.
+"""
+class TotalnumCube:
+    def __init__(self, cubedir):
+        self.cubedir = cubedir
+        with open(cubedir + '/meta.json') as f:
+            self.meta = json.load(f)
+        self.sites = self.meta['sites']
+        self.days = np.array(self.meta['days'], dtype='int32')
+        for name in ('fullname_int', 'lo', 'row_of', 'recent', 'series_ptr', 'series_site', 'series_day', 'series_count'):
+            setattr(self, name, np.load(cubedir + '/' + name + '.npy', mmap_mode='r'))
+
+    # Column of a site
+    def siteCol(self, site):
+        return self.sites.index(site)
+
+    # Row of a fullname_int (-1 if it is not in the cube)
+    def row(self, fullname_int):
+        return int(self.row_of[fullname_int]) if 0 <= fullname_int < len(self.row_of) else -1
+
+    # Slice of rows for the pre-order range lo..hi (inclusive), e.g., a node and its descendants from bigfullname
+    def rows(self, lo, hi):
+        return slice(int(np.searchsorted(self.lo, lo, 'left')), int(np.searchsorted(self.lo, hi, 'right')))
+
+    # Recent counts [rows x sites] for a slice of rows (all rows if None). Zero-copy.
+    def recentRows(self, rows=None):
+        return self.recent if rows is None else self.recent[rows]
+
+    # Time series of one row as (site column, day, count) arrays. Zero-copy.
+    def series(self, row):
+        a, b = self.series_ptr[row], self.series_ptr[row + 1]
+        return self.series_site[a:b], self.series_day[a:b], self.series_count[a:b]
+
+    # Dense [rows x sites x refresh dates] array for a slice of rows (NaN where there is no report)
+    def cube(self, rows):
+        rows = range(len(self.fullname_int))[rows]
+        out = np.full((len(rows), len(self.sites), len(self.days)), np.nan, dtype='float32')
+        a, b = self.series_ptr[rows.start], self.series_ptr[rows.stop]
+        rowidx = np.repeat(np.arange(len(rows)), np.diff(self.series_ptr[rows.start:rows.stop + 1]))
+        out[rowidx, self.series_site[a:b], np.searchsorted(self.days, self.series_day[a:b])] = self.series_count[a:b]
+        return out
+
+    # Day numbers as dates
+    def dates(self):
+        return self.days.astype('datetime64[D]')
@@ -1,11 +1,12 @@
 import json
-import sqlite3, pyodbc
+import numpy as np
 
 import time
 import keyring
 import networkx as nx
 import dash
 import dash_auth
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
 import pandas as pd
@@ -14,6 +15,12 @@ from dash.dependencies import Input, Output, State, MATCH, ALL
 import dash_bootstrap_components as dbc
 import plotly.express as px
 
+import totalnum_cache
+import totalnum_dbconn
+import totalnum_metrics
+import totalnum_ontology
+import totalnum_report
+
 """
 Requires Dash. Recommended install:
 1) Install Anaconda3
@@ -37,7 +44,14 @@ instruction = """
    * Top-right: Check boxes as desired. Site-by-site totalnum will appear, showing the breakdown in # patients per site (max among all refreshes).
    * Bottom: Click left or right arrow as desired. Network graph of current ontology level and its children are displayed, with node size indicating the totalnum per item (at selected site, max among all refreshes).
 """
+# Buttons per page in the nav list
+navpagesize = 50
+# Points in the cross-site graph above which it is drawn with WebGL (markers) instead of SVG bars
+webglpoints = 1000
+
 app = dash.Dash(external_stylesheets=[dbc.themes.CERULEAN],suppress_callback_exceptions=False)
+# Callback and query metrics (the callbacks are wrapped as they are defined; initApp sets the slow query log)
+metrics = totalnum_metrics.Metrics()
 
 # App Auth
 # Set username and password in local install, instead of hello world
@@ -72,10 +86,17 @@ app.layout = html.Div([
             dbc.Tab(html.Div([
                 dcc.Checklist(id='items', options=[{'label': 'No options', 'value': 'none'}], value=[],
                               labelStyle={'display': 'none'}),
+                dcc.Dropdown(id='search', placeholder='Search concepts', options=[], searchable=True),
+                dbc.Input(id='nav_filter', placeholder='Filter this level', debounce=True, size='sm'),
+                dbc.RadioItems(id='nav_order', options=[{'label':'By name','value':'name'},{'label':'By count','value':'count'}], value='name', inline=True),
                 dbc.ButtonGroup([
                    dbc.Button("no options")
                 ],vertical=True,id="navbuttons"),
                 html.Br(),
+                dbc.Button('<', id='nav_prev', outline=True, color='secondary', size='sm'),
+                html.Span('', id='nav_page_text', style={'margin':'5px','font-size':'10pt'}),
+                dbc.Button('>', id='nav_next', outline=True, color='secondary', size='sm'),
+                html.Br(),
                 dbc.Button('<--', id='unzoom', outline=True, color='primary'),
                 dbc.Button('-->', id='zoom', outline=True, color='primary')
             ],style={'width': '300px','margin':'20px'}),label='Navigate Terms')
@@ -83,23 +104,28 @@ app.layout = html.Div([
 
         dbc.Col(children=[dbc.Tabs([
             # Summary tab
-            dbc.Tab(dbc.Card([dbc.CardHeader('',id='summary_head'),dbc.CardBody(dcc.Markdown('',id='summary'))],color='secondary',style={'width': '800px'}),label='Summary',tab_id='summary_tab',label_style={"color": "blue"}),
+            dbc.Tab(html.Div([
+                dbc.Card([dbc.CardHeader('',id='summary_head'),dbc.CardBody(dcc.Markdown('',id='summary'))],color='secondary',style={'width': '800px'}),
+                html.Br(),
+                dbc.Card([dbc.CardHeader('Biggest drops since the last refresh'),dbc.CardBody(dbc.ListGroup([],id='drops'))],style={'width': '800px'})
+            ]),label='Summary',tab_id='summary_tab',label_style={"color": "blue"}),
             # Explorer tab
             dbc.Tab(dbc.Table([html.Tr([
                 html.Td(dbc.Tabs([
                     dbc.Tab(dcc.Graph(id='hlevel_graph'),label='Trends Over Time',tab_id='hlevel_tab',disabled=True),
-                    dbc.Tab(dcc.Graph(id='bars_graph',figure=go.Figure(data=go.Bar(y=[2, 3, 1]))),label='Trends Across Sites',tab_id='bars_tab',disabled=True)
+                    dbc.Tab(dcc.Graph(id='bars_graph'),label='Trends Across Sites',tab_id='bars_tab',disabled=True)
                 ],id='graphTabs'))] )
             ]),label="Explorer",tab_id='explorer_tab',label_style={"color": "blue"}),
             # Site variability tab
             dbc.Tab(dbc.Tabs([dbc.Tab(
-                html.Div([dbc.Row([dbc.Col(dcc.Slider(id='slider_siteoutlier',min=0,max=4,step=0.1,value=1)),dbc.Col(html.P('Threshold',id='slidertext_siteoutlier'))]),dbc.Row([
+                html.Div([dbc.Row([dbc.Col(dcc.Slider(id='slider_siteoutlier',min=0,max=4,step=0.1,value=1)),dbc.Col(html.P('Threshold',id='slidertext_siteoutlier'))]),
+                    dbc.Row([dbc.Col("Denominator:",width=2),dbc.Col(dbc.RadioItems(id='denom', options=[], inline=True))]),dbc.Row([
                     #dbc.Col(dcc.Checklist(id='items_siteoutlier', options=[{'label': 'No options', 'value': 'none'}], value=[],
                     #              labelStyle={'display': 'block'}),width={"size":3,"offset":1}),
                     dbc.Col(dcc.Graph(id='siteoutlier_graph'),width=9)
                     ])
                 ]),label='Explore'),
-                dbc.Tab(html.Div("Variability Report (not yet implemented)",id='report_div'),label='Report')]
+                dbc.Tab(html.Div("Select a single site for its variability report.",id='report_div'),label='Report')]
                 ),label='Site Variability',tab_id='siteoutlier_tab',label_style={"color":"blue"}),
             # Missingness tab
             dbc.Tab(dbc.Tabs([
@@ -111,7 +137,12 @@ app.layout = html.Div([
                     html.Div("# Missingness",id='missing_div'),
                     dbc.ListGroup([dbc.ListGroupItem(active=True)],id='missing')
                 ],label='Report')
-            ]),label="Missingness",tab_id='missing_tab',label_style={"color": "blue"})
+            ]),label="Missingness",tab_id='missing_tab',label_style={"color": "blue"}),
+            # Hierarchy consistency tab
+            dbc.Tab([
+                dbc.Alert("Concepts under the current path with more patients than their parent at the same site and refresh."),
+                html.Div("", id='hierarchy_div')
+            ],label="Consistency",tab_id='hierarchy_tab',label_style={"color": "blue"})
         ],id='mainTabs',active_tab='summary_tab')],width=9)
     ]),
 
@@ -119,26 +150,35 @@ app.layout = html.Div([
     html.Div('written by Jeffrey Klann, PhD'), html.Br(),
 #    html.Div('errmsghere-todo-', id='msg0'),
     html.Div('app_state', id='app_state'),
+    # The app state, once cbLoadData has fetched the data for it. The graphs and buttons are drawn when this changes.
+    dcc.Store(id='tab_data', data='app_state'),
     html.Br()
 ])
 
 """ For SQLite, dbtype = "SQLITE" and db = filename of db
     For MSSQL, dbtype = "MSSQL" and db is pyodbc format: DSN=MYMSSQL;UID=myuser;PWD=mypassword
     For MSSQL, dbtype = "MSSQL" and db is a dict of server, user, password, and db (e.g., dbo)
+    Each thread gets its own connection (see totalnum_dbconn). SQLite dbs are opened read-only and immutable, so
+    restart the dashboard after rebuilding the db, or pass immutable=False.
+    Query results are cached (see totalnum_cache) in cache_mb of memory, and in cache_dir if given, which can be
+    shared by all the gunicorn workers.
+    Queries slower than slow_query_ms are logged to the file slow_query_log (or printed). Metrics are on /metrics.
 """
-def initApp(*, dbtype="SQLITE",db="/Users/jklann/Google Drive/SCILHS Phase II/Committee, Cores, Panels/Informatics & Technology Core/totalnums/joined/totalnums.db"):
-    global conn,app,dbstyle,sites
+def initApp(*, dbtype="SQLITE",db="/Users/jklann/Google Drive/SCILHS Phase II/Committee, Cores, Panels/Informatics & Technology Core/totalnums/joined/totalnums.db",immutable=True,cache_mb=256,cache_dir=None,
+            slow_query_ms=500,slow_query_log=None):
+    global dbconns,cache,tree,app,dbstyle,sites,denoms
     # Initialize dashboard-wide globals
-    if dbtype=="SQLITE":
-        conn = sqlite3.connect(db,detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)  # Parameter converts datetimes
-    elif dbtype=="MSSQL":
-        conn = pyodbc.connect(db)
+    dbconns = totalnum_dbconn.ConnectionManager(dbtype, db, immutable=immutable)
+    cache = totalnum_cache.ResultCache(cache_mb * 1024 ** 2, cache_dir, stampfn=buildId)
+    metrics.slowms = slow_query_ms
+    metrics.slowlog = slow_query_log
+    conn = getConn()
     # Store db type - let's call it db style
     dbstyle=dbtype
     print("Dash version:"+str(dcc.__version__))
 
     # Get site list and store it in a global
-    sites = pd.read_sql("select distinct site from totalnums", conn).site.tolist()
+    sites = pd.read_sql("select site from sites order by site", conn).site.tolist()
     if 'All' not in sites: sites.append('All')
     options = list(map(lambda a: {'label': a, 'value': a}, sites))
     #options.append({'label':'All','value':'All'})
@@ -146,16 +186,228 @@ def initApp(*, dbtype="SQLITE",db="/Users/jklann/Google Drive/SCILHS Phase II/Co
     app.layout['site'].value = 'All'
     #app.layout['site'].children=[dbc.DropdownMenuItem(x) for x in sites]
 
+    # Denominators for the percent tables, the default first
+    try:
+        denoms = pd.read_sql("select denom, c_fullname from denominators order by ord", conn)
+    except pd.errors.DatabaseError:
+        denoms = pd.DataFrame(columns=['denom', 'c_fullname'])
+    app.layout['denom'].options = [{'label': d, 'value': d} for d in denoms.denom]
+    app.layout['denom'].value = denoms.denom.iloc[0] if len(denoms) > 0 else None
+
+    loadMissingBits()
+    tree = totalnum_ontology.OntologyTree(conn)
+
     return app.server
 
+# The connection for the current thread
+def getConn():
+    return dbconns.get()
+
+# The build stamp that totalnum_builddb_v2 writes (blank for dbs built before there was one)
+def buildId():
+    try:
+        stamp = querySql("select value from build_info where key='build_id'")
+    except pd.errors.DatabaseError:
+        return ''
+    return stamp.value.iloc[0] if len(stamp) > 0 else ''
+
+# Run a query on this thread's connection, recording its time and rows in the metrics
+def querySql(sql, params=None):
+    start = time.time()
+    df = pd.read_sql_query(sql, getConn(), params=params)
+    metrics.query(sql, time.time() - start, len(df))
+    return df
+
+# Look up key in the result cache, or compute() it, recording the hit or miss in the metrics
+def cached(key, compute):
+    missed = []
+    def miss():
+        missed.append(True)
+        return compute()
+    value = cache.get(key, miss)
+    metrics.cacheLookup(not missed)
+    return value
+
+# Run a query through the result cache. Don't modify the DataFrame it returns - it is shared.
+def readSql(sql):
+    return cached(sql, lambda: querySql(sql))
+
+# Result cache hit and miss counters
+@app.server.route('/cachestats')
+def cacheStats():
+    return flask.jsonify(cache.stats())
+
+# Callback and query metrics in the Prometheus text format, and the result cache's size
+@app.server.route('/metrics')
+def metricsText():
+    stats = cache.stats()
+    text = metrics.render({'totalnum_cache_entries': ('Entries in the result cache', stats['entries']),
+                           'totalnum_cache_bytes': ('Approximate size of the result cache', stats['bytes'])})
+    return flask.Response(text, mimetype='text/plain; version=0.0.4')
+
+# Record the size of each callback response
+@app.server.after_request
+def metricsResponse(response):
+    if flask.request.path.endswith('_dash-update-component') and not response.direct_passthrough:
+        metrics.response(len(response.get_data()))
+    return response
+
+""" Load the missingness bitsets (missing_bits, computed by totalnum_builddb_v2) into arrays indexed by fullname_int,
+    and the non-leaf, non-hidden concepts the missingness report lists. Also sets siteBits (site -> bit number).
+"""
+def loadMissingBits():
+    global siteBits,present,anyPresent,missingSubtree,nonleaf
+    conn = getConn()
+    siteBits = {s: i for i, s in enumerate(pd.read_sql("select site from sites order by site_int", conn).site.tolist())}
+    nbytes = (len(siteBits) + 7) // 8
+    size = pd.read_sql("select max(fullname_int) m from bigfullname", conn).m.iloc[0] + 1
+    c = conn.cursor()
+    c.execute("select fullname_int, present, missing_subtree from missing_bits")
+    rows = c.fetchall()
+    ids = np.array([r[0] for r in rows], dtype='int64')
+    present = np.zeros((size, nbytes), dtype='uint8')
+    missingSubtree = np.zeros((size, nbytes), dtype='uint8')
+    if len(rows) > 0:
+        present[ids] = np.frombuffer(b''.join(r[1] for r in rows), dtype='uint8').reshape(-1, nbytes)
+        missingSubtree[ids] = np.frombuffer(b''.join(r[2] for r in rows), dtype='uint8').reshape(-1, nbytes)
+    anyPresent = present.any(axis=1)
+    nonleaf = pd.read_sql("""select fullname_int, c_fullname, c_tooltip, c_hlevel, c_name from bigfullname
+        where c_visualattributes not like 'L%' and c_visualattributes not like '_H%'""", conn, index_col='fullname_int')
+
+# Test a site's bit in bitset rows (e.g., present[ids]); all False for a site that is not in the db (like 'All')
+def siteBit(bitsets, site):
+    if site not in siteBits: return np.zeros(len(bitsets), dtype=bool)
+    b = siteBits[site]
+    return (bitsets[:, b // 8] >> (b % 8)) & 1 == 1
+
+""" Where clause for the children of the current path, using the hierarchy index (bigfullname.parent_int) built by
+    totalnum_builddb_v2 rather than a c_hlevel + c_fullname LIKE scan. The top of the tree need not be a node itself,
+    in which case its children are the roots (parent_int=-1) under that path. The node is looked up in the in-memory tree.
+    alias qualifies parent_int (e.g., 't.') for joins with another table that has one.
+"""
+def childrenWhere(appstatedict, alias=''):
+    path = '\\'.join(appstatedict['path']) + '\\'
+    row = tree.find(path)
+    if row >= 0:
+        return " where %sparent_int=%d" % (alias, tree.ids[row])
+    return " where %sparent_int=-1 and c_fullname like '%s'" % (alias, path + '%')
+
+""" Everything the active tab needs for an app state, fetched in one batched query (through the result cache, so the
+    callbacks that draw the tab share it) and split into DataFrames by part:
+    nav - the children of the current path, for the buttons. These come from the in-memory tree, except on the site
+      variability tab, where they come from the db, one row per concept, flagged as an outlier if any selected site is one.
+    series - explorer tab: each child's counts at the selected site at each refresh
+    trend - explorer tab: each child's control limits at the selected site (avg and stdev of the baseline, lcl, ucl)
+    max - explorer tab: each child's max count (c) and most recent count (recent, at refresh_date) at each site, from
+      the rollup table (totalnums_rollup), which is clustered by parent so this is one range read
+    pct - site variability tab: each child's percent of the selected denominator at each site
+    avg - site variability tab: each child's average percent across sites and slider * stdev
+"""
+def tabData(appstatedict):
+    where = childrenWhere(appstatedict)
+    tab = appstatedict['tab']
+    site = appstatedict['site']
+    join = " t inner join bigfullname b on t.fullname_int=b.fullname_int" + where
+    rollupjoin = " t inner join bigfullname b on t.fullname_int=b.fullname_int" + childrenWhere(appstatedict, 't.')
+    path = '\\'.join(appstatedict['path']) + '\\'
+    nav = cached('nav:' + path, lambda: tree.frame(tree.childRows(appstatedict['path'])))
+    if tab=='explorer_tab':
+        sql = """select 'series' part, b.fullname_int, c_fullname, c_name, c_visualattributes, site, refresh_date, c, null recent, null avg, null stdev, null lcl, null ucl from totalnums_oldcols {join} and site='{site}'
+            union all
+            select 'trend', b.fullname_int, c_fullname, c_name, c_visualattributes, site, last_date, last_count, null, mean, stdev, lcl, ucl from totalnums_trend {join} and site='{site}'
+            union all
+            select 'max', b.fullname_int, c_fullname, c_name, c_visualattributes, site, recent_date, max_count, recent_count, null, null, null, null from totalnums_rollup {rollupjoin} and site!='All'
+            order by part, refresh_date""".format(join=join, rollupjoin=rollupjoin, site=site)
+    elif tab=='siteoutlier_tab':
+        sitewhere = "" if site=='All' else " and site='%s'" % site
+        join += " and denom='%s'" % appstatedict['denom']
+        sql = """select 'nav' part, b.fullname_int, c_fullname, c_name, c_visualattributes, null site, max(abs(pct-average)>({slider}*stdev)) outlier, null c, null avg, null stdev from outliers_sites_pct {join}{sitewhere} group by b.fullname_int
+            union all
+            select 'pct', b.fullname_int, c_fullname, c_name, c_visualattributes, site, null, max(pct), null, null from totalnums_pct {join} and site!='All' group by b.fullname_int, site
+            union all
+            select distinct 'avg', b.fullname_int, c_fullname, c_name, c_visualattributes, null, null, null, average, ({slider}*stdev) from outliers_sites_pct {join} and site!='All'
+            """.format(join=join, sitewhere=sitewhere, slider=str(appstatedict['slider']))
+    elif tab=='missing_tab':
+        # Only non-leaf, non-hidden concepts; outlier and missing-below flags come from the bitsets
+        va = nav.c_visualattributes.str
+        return {'nav': nav[~va.startswith('L') & (va[1:2] != 'H')]}
+    else:
+        return {'nav': nav}
+    df = readSql(sql)
+    data = {part: rows for part, rows in df.groupby('part', sort=False)}
+    if tab=='explorer_tab': data['nav'] = nav
+    return data
+
+# Total recent count of each child of the current path (at the selected site, or all sites), indexed by fullname_int
+def childCounts(appstatedict):
+    site = appstatedict['site']
+    sql = "select r.fullname_int, sum(agg_count) c from totalnums_recent r inner join bigfullname b on r.fullname_int=b.fullname_int" + \
+        childrenWhere(appstatedict) + " and agg_count>0" + ("" if site=='All' else " and site='%s'" % site) + " group by r.fullname_int"
+    return readSql(sql).set_index('fullname_int')['c']
+
+""" Hierarchy violations (hierarchy_violations, from totalnum_builddb_v2) under the current path, at the selected site (or
+    all sites), the largest excess over the parent first. The nodes under a path are a range of pre-order ranks (lo),
+    which is the violation table's primary key. total is the number of violations, of which the first limit are listed.
+"""
+def hierarchyViolations(appstatedict, limit=100):
+    start, stop = tree.prefixRange('\\'.join(appstatedict['path']) + '\\')
+    if start >= stop: return pd.DataFrame(columns=['c_name', 'site', 'agg_date', 'child_count', 'parent', 'parent_count', 'excess', 'total'])
+    site = appstatedict['site']
+    sql = """select b.c_name, v.site, date(v.agg_date) agg_date, v.child_count, p.c_name parent, v.parent_count, v.excess, count(*) over () total
+        from hierarchy_violations v inner join bigfullname b on b.fullname_int=v.fullname_int inner join bigfullname p on p.fullname_int=v.parent_int
+        where v.lo between (select min(lo) from bigfullname where fullname_int=%d) and (select max(lo) from bigfullname where fullname_int=%d)%s
+        order by v.excess desc limit %d""" % (tree.ids[start], tree.ids[stop - 1], "" if site=='All' else " and v.site='%s'" % site, limit)
+    return readSql(sql)
+
+# Get the part of tabData for a state (empty if there is none)
+def tabPart(data, part):
+    return data[part] if part in data else pd.DataFrame(columns=['fullname_int', 'c_fullname', 'c_name', 'c_visualattributes', 'site', 'refresh_date', 'c', 'recent', 'avg', 'stdev', 'lcl', 'ucl', 'outlier'])
+
 # This callback just clears the checkboxes when the button is pressed, otherwise they are never cleared when the
-# options are updated and hidden checkboxes accumulate in the state.
+# options are updated and hidden checkboxes accumulate in the state. The nav filter is for one level, so it's cleared too,
+# except that a search result is shown by filtering its level to its name.
 @ app.callback(
-    Output('items', 'value'),
-    [Input('zoom', 'n_clicks'), Input('unzoom', 'n_clicks')]
+    [Output('items', 'value'), Output('nav_filter', 'value')],
+    [Input('zoom', 'n_clicks'), Input('unzoom', 'n_clicks'), Input('search', 'value')]
+)
+@metrics.callback
+def clearTheChecks(clix, unclix, search):
+    if search and 'search' in dash.callback_context.triggered[0]['prop_id']:
+        row = tree.find(search)
+        return [], tree.name(row) if row >= 0 else ''
+    return [], ''
+
+""" Concepts matching search text, best first, as a DataFrame of c_fullname, c_name, c_tooltip. Uses the FTS5 index
+    that totalnum_builddb_v2 builds (bigfullname_fts) with every word as a prefix, ranked by bm25 with c_name weighted
+    most. Falls back to a LIKE search on c_name on dbs without the index.
+"""
+def searchConcepts(text, limit=20):
+    words = text.split()
+    if not words: return pd.DataFrame(columns=['c_fullname', 'c_name', 'c_tooltip'])
+    match = ' '.join('"%s"*' % w.replace('"', '""') for w in words)
+    def search():
+        try:
+            return querySql("""select c_fullname, c_name, c_tooltip from bigfullname_fts where bigfullname_fts match ?
+                order by bm25(bigfullname_fts, 10.0, 1.0, 3.0) limit ?""", params=(match, limit * 2))
+        except pd.errors.DatabaseError:
+            return querySql("select c_fullname, c_name, c_tooltip from bigfullname where c_name like ? limit ?",
+                            params=('%' + text + '%', limit * 2))
+    # Paths can be in bigfullname more than once. Tooltips (and even names) are optional, so they can be null.
+    return cached('search:%d:%s' % (limit, match), search).drop_duplicates('c_fullname').head(limit).fillna({'c_name': '', 'c_tooltip': ''})
+
+# Fill in the search results as the user types
+@app.callback(
+    Output('search', 'options'),
+    [Input('search', 'search_value')],
+    [State('search', 'value')]
 )
-def clearTheChecks(clix, unclix):
-    return []
+@metrics.callback
+def cbSearchOptions(search_value, value):
+    # Keep the options (so the chosen one keeps its label) until there is something to search for
+    if not search_value or len(search_value) < 2: return dash.no_update
+    results = searchConcepts(search_value)
+    return [{'label': (r['c_name'] or r['c_fullname']) + (' (' + r['c_tooltip'][:80] + ')' if r['c_tooltip'] else ''), 'value': r['c_fullname']}
+            for r in results.to_dict('records')]
 
 # New callback to print help
 @app.callback(
@@ -163,6 +415,7 @@ def clearTheChecks(clix, unclix):
     [Input('help','n_clicks')],
     [State('modalHelp','is_open')]
 )
+@metrics.callback
 def cbHelp(help,is_open):
     if help:
         return not is_open
@@ -174,6 +427,7 @@ def cbHelp(help,is_open):
     [Input('site', 'value')],
     [State('app_state', 'children')]
 )
+@metrics.callback
 def cbSiteSwitchTab(site,app_state):
     if site=='All':
         return 'bars_tab'
@@ -186,8 +440,9 @@ def cbSiteSwitchTab(site,app_state):
     [Input('site','value')],
     [State('app_state','children')]
 )
+@metrics.callback
 def cbSummaryHead(site,app_state):
-    global conn
+    conn = getConn()
     if site is not None and site!='All':
         return site+' Summary'
     elif site=='All':
@@ -202,7 +457,7 @@ def cbSummaryHead(site,app_state):
     [State('app_state','children')]
 )
 def cbSummary(site,app_state):
-    global conn
+    conn = getConn()
     if site is not None and site!='All':
         appstatedict = json.loads(app_state)
         if appstatedict['tab']=='summary_tab' and appstatedict['action']!='':
@@ -215,12 +470,45 @@ def cbSummary(site,app_state):
     return ""
 """
 
+# New callback: list the concepts whose counts dropped the most at the site's last refresh (from totalnums_trend)
+@app.callback(
+    Output('drops', 'children'),
+    [Input('site','value')]
+)
+@metrics.callback
+def cbDrops(site):
+    if not site or site not in siteBits:
+        return [dbc.ListGroupItem("Select a single site to see its biggest drops.")]
+    sql = """select c_name, last_date, last_count, prev_count, delta, pct_change, breach from totalnums_trend t
+        inner join bigfullname b on t.fullname_int=b.fullname_int where site='%s' and delta<0 order by delta limit 20""" % site
+    df = readSql(sql)
+    if len(df) == 0: return [dbc.ListGroupItem("No drops at this site.")]
+    # Red if the last count is outside the control limits
+    return [dbc.ListGroupItem("%s: %d to %d (%d%s) on %s" % (x['c_name'], x['prev_count'], x['last_count'], x['delta'],
+                              '' if pd.isna(x['pct_change']) else ', %.0f%%' % x['pct_change'], str(x['last_date'])[0:10]),
+                              color='danger' if x['breach']==1 else None) for x in df.to_dict('records')]
+
+# New callback: the variability report for a site (the same list as in its totalnum_report), at the slider's threshold
+@app.callback(
+    Output('report_div', 'children'),
+    [Input('site','value'), Input('slider_siteoutlier','value'), Input('denom','value')]
+)
+@metrics.callback
+def cbVariabilityReport(site, slider, denom):
+    if not site or site not in siteBits or not denom:
+        return "Select a single site for its variability report."
+    df = readSql(totalnum_report.outlierSql(site, denom, slider if slider else 0))
+    if len(df) == 0: return "No concepts at %s are more than %s stdevs from the average." % (site, slider)
+    return [html.P("Concepts whose percent of the %s denominator is more than %s stdevs from the network average (z), furthest first." % (denom, slider)),
+            dbc.Table.from_dataframe(df.round(2), size='sm', striped=True)]
+
 # New callback: update outlier options when the slider is changed
 @app.callback(
     Output('slidertext_siteoutlier', 'children'),
     [Input('slider_siteoutlier','value')],
     [State('app_state','children')]
 )
+@metrics.callback
 def cbSiteoutlierSliderText(slider,app_state):
     return "Threshold: " + str(slider)
 
@@ -230,6 +518,7 @@ def cbSiteoutlierSliderText(slider,app_state):
     [Input('mainTabs','active_tab')],
     [State('app_state','children'),State('site','value')]
 )
+@metrics.callback
 def cbActiveTabSiteAdjustment(active_tab,app_state,already_site):
     print("ACTIVE" + already_site)
     return ""
@@ -241,7 +530,7 @@ def cbActiveTabSiteAdjustment(active_tab,app_state,already_site):
     [State('app_state','children')]
 )"""
 def cbSiteoutlierItems(slider,site,app_state):
-    global conn
+    conn = getConn()
     c = conn.cursor()
     #appstatedict = json.loads(app_state)
 
@@ -261,18 +550,16 @@ def cbSiteoutlierItems(slider,site,app_state):
     [Input('site','value')],
     [State('app_state','children')]
 )
+@metrics.callback
 def cbMissingMd(site,app_state):
-    global conn
+    conn = getConn()
     if (app_state == 'app_state'): return {}
     appstatedict = json.loads(app_state)
     if appstatedict['tab'] == 'missing_tab':
-        c = conn.cursor()
         # TODO: This is all non-leaf missingness. Probably want to look at leaf variance between sites vs. annotated high level missing
-        query = """select c_fullname, c_tooltip, c_hlevel, c_name from bigfullname fn inner join totalnums_recent r on r.fullname_int=fn.fullname_int 
-          where fn.fullname_int not in (select fullname_int from totalnums_recent where site='{{}}') and c_visualattributes not like 'L%' and c_visualattributes not like '_H%'
-          order by c_hlevel """
-        query=query.replace("{{}}",site)
-        df = pd.read_sql_query(query,conn)
+        # Missing at this site but present elsewhere, from the bitsets
+        missing = np.flatnonzero(anyPresent & ~siteBit(present, site))
+        df = nonleaf.loc[nonleaf.index.intersection(missing)]
         df=df.sort_values(by='c_fullname',axis=0,ascending=True)
         # I had this on one line but was too hard to debug
         # Compute a readable string for missingness
@@ -298,7 +585,7 @@ def cbMissingMd(site,app_state):
 #    [State('app_state','children')]
 #)
 def cbMissing(site,app_state):
-    global conn
+    conn = getConn()
     c = conn.cursor()
     # TODO: This is all non-leaf missingness. Probably want to look at leaf variance between sites vs. annotated high level missing
     query = """select c_tooltip, c_hlevel, c_name from bigfullname fn inner join totalnums_recent r on r.fullname_int=fn.fullname_int 
@@ -323,29 +610,28 @@ def cbMissing(site,app_state):
 # Also updates the state JSON when a button is clicked or the dropdown is used
 @app.callback(
     Output('app_state','children'),
-    [Input({'type': 'navbutton', 'index': ALL}, 'n_clicks'),Input('zoom', 'n_clicks'), Input('unzoom', 'n_clicks'), Input('site', 'value'),Input('mainTabs','active_tab'),Input('slider_siteoutlier','value')],
+    [Input({'type': 'navbutton', 'index': ALL}, 'n_clicks'),Input('zoom', 'n_clicks'), Input('unzoom', 'n_clicks'), Input('site', 'value'),Input('mainTabs','active_tab'),Input('slider_siteoutlier','value'),
+     Input('nav_prev', 'n_clicks'), Input('nav_next', 'n_clicks'), Input('nav_filter', 'value'), Input('nav_order', 'value'), Input('search', 'value'),
+     Input('denom', 'value')],
     [State('items', 'value'), State('items', 'options'),State('app_state','children')]
 )
-def cbController(nclick_values,zoomclix,unzoomclix,site,tab,slider,checks,options,appstate):
-    global conn,dbstyle, sites,globalDbFile
+@metrics.callback
+def cbController(nclick_values,zoomclix,unzoomclix,site,tab,slider,prevclix,nextclix,navfilter,navorder,search,denom,checks,options,appstate):
+    global dbstyle, sites,globalDbFile
     if appstate=='app_state':
         # New version of Dash, cannot share sqlite across windows
         #initApp(db=globalDbFile)
         # Initialize the app
-        c = conn.cursor()
         zoom_clix = 0
         unzoom_clix = 0
-        c.execute("select min(c_hlevel) from bigfullname")
-        hlevel = c.fetchone()[0]
+        # The ontology tree is in memory
+        hlevel = tree.minhlevel
         minhlevel = hlevel
-        #query = "select top 1 c_fullname from bigfullname where c_hlevel=?" if dbstyle=="MSSQL" else "select c_fullname from bigfullname where c_hlevel=? limit 1"
-        #c.execute(query, str(hlevel)) # Limit 1 for PGSQL
-        c.execute("select c_fullname from bigfullname where c_hlevel="+str(hlevel)+" limit 1") # NOT SUPPORTING MSSQL RIGHT NOW TODO
-        pathstart = c.fetchone()[0]
-        pathstart = pathstart[0:pathstart[1:].find('\\') + 1]
-        path = [pathstart]
+        path = [tree.startPath()]
         site = 'All' if 'All' in sites else sites[0] # There must be at least 1 site
-        app_state = {'action':'','zoom_clix': 0, 'unzoom_clix': 0, 'hlevel':hlevel,'minhlevel': minhlevel, 'path': path, 'site': site,'tab':tab, "slider":slider, 'selected':[], 'selected_new':""}
+        app_state = {'action':'','zoom_clix': 0, 'unzoom_clix': 0, 'hlevel':hlevel,'minhlevel': minhlevel, 'path': path, 'site': site,'tab':tab, "slider":slider, 'selected':[], 'selected_new':"",
+                     'prev_clix': 0, 'next_clix': 0, 'nav_page': 0, 'nav_filter': '', 'nav_order': 'name', 'search': None,
+                     'denom': denom if denom else (denoms.denom.iloc[0] if len(denoms) > 0 else None)}
         return json.dumps(app_state)
 
     appstatedict = json.loads(appstate)
@@ -353,10 +639,16 @@ def cbController(nclick_values,zoomclix,unzoomclix,site,tab,slider,checks,option
     # If slider was moved but not button click, or callback called on startup, or multiple checked or nothing checked
     unclix = 0 if unzoomclix is None else unzoomclix
     clix=0 if zoomclix is None else zoomclix
+    prevclix = 0 if prevclix is None else prevclix
+    nextclix = 0 if nextclix is None else nextclix
+    navfilter = navfilter if navfilter else ''
 
     if (slider and slider != appstatedict['slider']):
         # Tab changed
         appstatedict['slider']=slider
+    if (denom and denom != appstatedict['denom']):
+        # Denominator changed - the site variability tab is redrawn from the percent tables for it
+        appstatedict['denom']=denom
     if (tab and tab != appstatedict['tab']):
         # Tab changed
         appstatedict['tab']=tab
@@ -366,6 +658,17 @@ def cbController(nclick_values,zoomclix,unzoomclix,site,tab,slider,checks,option
         print("New site selected:" + site)
         print("Controller - New Site selected")
         appstatedict['action']='site'
+    elif search and search != appstatedict['search'] and tree.find(search) >= 0:
+        # Search result picked - jump to the level it is listed at, and select it
+        appstatedict['search'] = search
+        appstatedict['path'] = tree.pathTo(tree.find(search))
+        appstatedict['hlevel'] = int(appstatedict['minhlevel']) + len(appstatedict['path']) - 1
+        appstatedict['action'] = 'search'
+        appstatedict['selected_new'] = search
+        appstatedict['selected'] = [search]
+        appstatedict['nav_page'] = 0
+        appstatedict['nav_filter'] = navfilter
+        print("Controller - Search:" + str(appstatedict['path']))
     elif unclix != appstatedict['unzoom_clix']:
         appstatedict['unzoom_clix'] = unclix
         if int(appstatedict['hlevel']) > int(appstatedict['minhlevel']):
@@ -374,6 +677,8 @@ def cbController(nclick_values,zoomclix,unzoomclix,site,tab,slider,checks,option
             appstatedict['action']='unzoom'
             appstatedict['selected_new']=''
             appstatedict['selected']=[]
+            appstatedict['nav_page']=0
+            appstatedict['nav_filter']=''
             print("Controller - Unzoom:" + str(appstatedict['path']))
     #elif len(checks) == 0 or len(checks) > 1:
     #    appstatedict['action']='none'
@@ -386,12 +691,24 @@ def cbController(nclick_values,zoomclix,unzoomclix,site,tab,slider,checks,option
         # new version just rebuilds the path string each time in case there segments like in ACT that just provide version info and are not part of the hierarchy
         #appstatedict['path']=appstatedict['selected_new'].split('\\')[:-1]
         # even newer version only adds one path element for reverse navigation but preserves untraversed segments in the path
-        appstatedict['path'].append(
-            appstatedict['selected_new'][appstatedict['selected_new'].find('\\'.join(appstatedict['path']))+len('\\'.join(appstatedict['path']))+1:-1])
+        appstatedict['path'] = tree.zoomPath(appstatedict['path'], appstatedict['selected_new'])
         appstatedict['action']='zoom'
         appstatedict['selected_new'] = ''
         appstatedict['selected'] = []
+        appstatedict['nav_page'] = 0
+        appstatedict['nav_filter'] = ''
         print("Controller - Zoom:" + str(appstatedict['path']))
+    # Paging, filtering or reordering the nav list keeps the selection, so the graphs stay as they are
+    elif prevclix != appstatedict['prev_clix'] or nextclix != appstatedict['next_clix']:
+        appstatedict['nav_page'] = max(0, appstatedict['nav_page'] + (nextclix - appstatedict['next_clix']) - (prevclix - appstatedict['prev_clix']))
+        appstatedict['prev_clix'] = prevclix
+        appstatedict['next_clix'] = nextclix
+        appstatedict['action'] = 'page'
+    elif navfilter != appstatedict['nav_filter'] or (navorder and navorder != appstatedict['nav_order']):
+        appstatedict['nav_filter'] = navfilter
+        appstatedict['nav_order'] = navorder if navorder else 'name'
+        appstatedict['nav_page'] = 0
+        appstatedict['action'] = 'page'
 
     # Nav buttons were clicked
     # Index is the index element of the id
@@ -412,82 +729,105 @@ def cbController(nclick_values,zoomclix,unzoomclix,site,tab,slider,checks,option
 
 
 
+# Fetch the data for the app state once (into the result cache), then pass the state on to the callbacks that draw it
+@app.callback(
+    Output('tab_data', 'data'),
+    [Input('app_state','children')]
+)
+@metrics.callback
+def cbLoadData(state):
+    if (state=='app_state'): return state
+    tabData(json.loads(state))
+    return state
+
 # This is the callback when someone clicks the zoom button, which moves down the hierarchy
 # It also needs to handle the base case of just setting the state of the items.
 # THIS VERSION DOES IT WITH BUTTONS!
 @app.callback(
-    Output('navbuttons', 'children'),
+    [Output('navbuttons', 'children'), Output('nav_page_text', 'children'), Output('nav_prev', 'disabled'), Output('nav_next', 'disabled')],
 #    [Input('zoom', 'n_clicks'), Input('unzoom', 'n_clicks')],
-    [Input('app_state','children')],
+    [Input('tab_data','data')],
     [State('items', 'value'), State('navbuttons', 'children')]
 )
+@metrics.callback
 def cbNavigateButtons(state, checks, options):
-    global conn
-    if (state=='app_state'): return options
+    if (state=='app_state'): return options, dash.no_update, dash.no_update, dash.no_update
     appstatedict = json.loads(state)
 
-    # Update only if we navigated the ontology or if we're in the outlier tab (which has a bunch of thinks)
-    if appstatedict['action'] in ('zoom','unzoom','') or appstatedict['tab']=='siteoutlier_tab':
-        #sql_select = "select distinct c_fullname AS value,c_name AS label from totalnums_oldcols t inner join bigfullname b on t.fullname_int=b.fullname_int "
-        if appstatedict['tab']=='explorer_tab':
-            sql_select = "select distinct c_visualattributes, c_fullname AS value,c_name AS label from bigfullname " # speedup compared to totalnums_recent_joined
-        elif appstatedict['tab']=='siteoutlier_tab':
-            sql_select = "select distinct  abs(pct-average)>(%s*stdev) as outlier,c_fullname AS value,c_name AS label, c_visualattributes from outliers_sites_pct t inner join bigfullname b on t.fullname_int=b.fullname_int " % (
-                str(appstatedict['slider']))
-        elif appstatedict['tab']=='missing_tab':
-            sql_select = """select c_fullname, c_tooltip, c_hlevel, c_name from bigfullname fn inner join totalnums_recent r on r.fullname_int=fn.fullname_int 
-              where fn.fullname_int not in (select fullname_int from totalnums_recent where site='{{}}') and c_visualattributes not like 'L%' and c_visualattributes not like '_H%'
-              order by c_hlevel """
-            sql_select = """select case when notin is null then 1 else 0 end outlier, c_fullname as value, c_name as label, c_visualattributes from 
-             (select distinct fn.c_fullname, fn.c_tooltip, fn.c_hlevel, fn.c_name, fn.c_visualattributes, notin.fullname_int notin from bigfullname fn inner join totalnums_recent r on r.fullname_int=fn.fullname_int
-              left outer join (select * from totalnums_recent where site='{{}}') notin on notin.fullname_int=fn.fullname_int
-               where c_visualattributes not like 'L%' and c_visualattributes not like '_H%'
-              order by c_hlevel) x """
-            sql_select = sql_select.replace("{{}}", appstatedict['site'])
-        else:
-            sql_select = "select distinct c_fullname AS value,c_name AS label, c_visualattributes from bigfullname " # speedup compared to totalnums_recent_joined
-
+    # Update only if we navigated the ontology, changed the nav page, or if we're in the outlier tab (which has a bunch of thinks)
+    if appstatedict['action'] in ('zoom','unzoom','','page','site','search') or appstatedict['tab']=='siteoutlier_tab':
         # Compute the items for the checkboxes and return
-        # Special logic to get all items in ontology if missing tab or all sites are selected
-        if appstatedict['site']=='All' or appstatedict['tab']=='missing_tab' or appstatedict['tab']=='explorer_tab':
-            sql_where=" where c_hlevel='%s' and c_fullname like '%s'" % (
-                str(appstatedict['hlevel']), '\\'.join(appstatedict['path']) + '\\%')
+        # The site filter (on the site variability tab, unless all sites are selected) is in tabData's query
+        items = tabPart(tabData(appstatedict), 'nav').rename(columns={'c_fullname': 'value', 'c_name': 'label'})
+        if appstatedict['tab']=='missing_tab':
+            # Only concepts present at some site; outlier = missing at this site, missing_below = missing somewhere beneath
+            ids = items['fullname_int'].to_numpy()
+            items = items[anyPresent[ids]]
+            ids = items['fullname_int'].to_numpy()
+            items = items.assign(outlier=(~siteBit(present[ids], appstatedict['site']) & (appstatedict['site'] in siteBits)).astype(int),
+                                 missing_below=siteBit(missingSubtree[ids], appstatedict['site']).astype(int))
+
+        # Filter, order and page - only the visible page of buttons is sent to the browser
+        navfilter = appstatedict.get('nav_filter', '')
+        if navfilter:
+            items = items[items['label'].str.contains(navfilter, case=False, regex=False, na=False)]
+        if appstatedict.get('nav_order') == 'count' and len(items) > 0:
+            counts = childCounts(appstatedict)
+            items = items.assign(count=counts.reindex(items['fullname_int']).fillna(0).to_numpy()).sort_values('count', ascending=False, kind='stable')
         else:
-            sql_where = " where c_hlevel='%s' and site='%s' and c_fullname like '%s'" % (
-             str(appstatedict['hlevel']), appstatedict['site'], '\\'.join(appstatedict['path']) + '\\%')
-
-        items = pd.read_sql_query(sql_select+sql_where, conn).to_dict('records')
-        print(sql_select+sql_where)
+            items = items.sort_values('label', key=lambda x: x.str.lower(), kind='stable')
+        npages = max(1, -(-len(items) // navpagesize))
+        page = min(appstatedict.get('nav_page', 0), npages - 1)
+        pagetext = "%d-%d of %d" % (page * navpagesize + 1 if len(items) else 0, min((page + 1) * navpagesize, len(items)), len(items))
+        items = items.iloc[page * navpagesize:(page + 1) * navpagesize].to_dict('records')
 
         out = []
         for i in items:
             out.append(dbc.Button(i['label'],className="mr-1", id={'type':'navbutton','index':i['value']},
                                   style={'font-size':'10pt'},
-                                  color=('danger' if 'outlier' in i and i['outlier']==1 else 'dark'),
+                                  color=('danger' if 'outlier' in i and i['outlier']==1 else 'warning' if 'missing_below' in i and i['missing_below']==1 else 'dark'),
                                   outline=(True if i['c_visualattributes'] in ('FAE','FA','FA ','CA ','CAE','CA') else False)))
-        return out
+        return out, pagetext, page == 0, page >= npages - 1
     if appstatedict['action']=='navclick':
         appstatedict['selected']
 
-    return options
+    return options, dash.no_update, dash.no_update, dash.no_update
+
+# New callback: list the hierarchy violations under the current path on the consistency tab
+@app.callback(
+    Output('hierarchy_div', 'children'),
+    [Input('tab_data', 'data')]
+)
+@metrics.callback
+def cbHierarchy(state):
+    if (state=='app_state'): return dash.no_update
+    appstatedict = json.loads(state)
+    if appstatedict['tab'] != 'hierarchy_tab': return dash.no_update
+    path = '\\'.join(appstatedict['path']) + '\\'
+    where = path + ('' if appstatedict['site']=='All' else ' at ' + appstatedict['site'])
+    try:
+        df = hierarchyViolations(appstatedict)
+    except pd.errors.DatabaseError:
+        return "No hierarchy violations table in this db. Rebuild it with totalnum_builddb_v2 to check."
+    if len(df) == 0: return "No child concepts with more patients than their parent under %s." % where
+    return [html.P("%d violations under %s, the largest first%s." % (df.total.iloc[0], where, '' if df.total.iloc[0] <= len(df) else ' (the first %d)' % len(df))),
+            dbc.Table.from_dataframe(df.drop(columns='total'), size='sm', striped=True)]
 
 # This callback draws the graph whenever checkboxes change or site is changed
 @app.callback(
     Output('hlevel_graph', 'figure'),
-    [Input('app_state', 'children')],
+    [Input('tab_data', 'data')],
     [State('navbuttons', 'children'), State('hlevel_graph', 'figure')]
 )
+@metrics.callback
 def cbLineGraphButtons(state, navbuttons,oldfig):
-    global conn
     if (state=='app_state'): return {}
-    start = time.time()
     appstatedict = json.loads(state)
-    if appstatedict['action'] in ('navclick','zoom','site') and appstatedict['tab']=='explorer_tab':
+    if appstatedict['action'] in ('navclick','zoom','site','search') and appstatedict['tab']=='explorer_tab':
         # Get just the available data in the df
-        sql = "select distinct c_fullname,refresh_date,c_name,c from totalnums_oldcols t inner join bigfullname b on t.fullname_int=b.fullname_int where c_hlevel='%s' and site='%s' and c_fullname like '%s' order by refresh_date asc" % (
-         appstatedict['hlevel'], appstatedict['site'], '\\'.join(appstatedict['path']) + '\\%')
-        print(sql)
-        dfsub = pd.read_sql_query(sql, conn)
+        data = tabData(appstatedict)
+        dfsub = tabPart(data, 'series')
+        dftrend = tabPart(data, 'trend')
 
         traces = []
         ymax = 0
@@ -498,109 +838,70 @@ def cbLineGraphButtons(state, navbuttons,oldfig):
                     go.Scatter(x=xf['refresh_date'], y=xf['c'], text=xf.iloc[0, :].c_name, name=xf.iloc[0, :].c_name,
                                marker={'size': 15}, mode='lines+markers'))
                 ymax=max(ymax,xf.groupby(by='c_fullname').max()['c'].values[0]) # Fix 11-19 - put the legend in the right place
-                Cstd=xf['c'].std()
-                Cmean=xf['c'].mean()
-                Clow = Cmean - 3*Cstd
-                if Clow<0: Clow=0
-                #traces.append(go.Scatter(x=[xf['refresh_date'].min(),xf['refresh_date'].max()],y=[Cmean,Cmean],name='mean of '+xf.iloc[0,:].c_name,mode='lines')) # Mean
-                #traces.append(go.Scatter(x=[xf['refresh_date'].min(), xf['refresh_date'].max()], y=[Cmean+3*Cstd, Cmean+3*Cstd],
-                #                        name='high control of ' + xf.iloc[0, :].c_name, mode='lines'))
-                #traces.append(go.Scatter(x=[xf['refresh_date'].min(), xf['refresh_date'].max()], y=[Clow, Clow],
-                #                         name='low control of ' + xf.iloc[0, :].c_name, mode='lines'))
-        print("Graph time:"+str(time.time()-start)+",traces:"+str(len(traces)))
+                # Control band from the precomputed baseline limits (totalnums_trend), if there are enough refreshes
+                xt = dftrend[dftrend.c_fullname == n]
+                if len(xt) > 0 and pd.notna(xt['stdev'].iloc[0]):
+                    xrange = [xf['refresh_date'].min(), xf['refresh_date'].max()]
+                    name = xf.iloc[0, :].c_name
+                    traces.append(go.Scatter(x=xrange, y=[xt['ucl'].iloc[0]] * 2, name='high control of ' + name, legendgroup=n,
+                                             mode='lines', line={'width': 0}, showlegend=False))
+                    traces.append(go.Scatter(x=xrange, y=[xt['lcl'].iloc[0]] * 2, name='control band of ' + name, legendgroup=n,
+                                             mode='lines', line={'width': 0}, fill='tonexty', fillcolor='rgba(128,128,128,0.2)'))
+                    traces.append(go.Scatter(x=xrange, y=[xt['avg'].iloc[0]] * 2, name='mean of ' + name, legendgroup=n,
+                                             mode='lines', line={'dash': 'dash'}))
         layout =  {'legend':{'x':0,'y':ymax},'showlegend':True}
         return {'data': traces, 'layout': layout}
     return oldfig if oldfig is not None else {}
 
-# This callback draws the bar graph whenever checkboxes change
+# This callback draws the cross-site graph (max count of each concept at each site) whenever the level or checkboxes change
 @app.callback(
     Output('bars_graph', 'figure'),
-    [Input('app_state', 'children')],
+    [Input('tab_data', 'data')],
     [State('navbuttons', 'children')]
 )
+@metrics.callback
 def cbBarGraphButtons(state,navbuttons):
-    global conn
     if (state=='app_state'): return {}
-    start = time.time()
     appstatedict = json.loads(state)
     if appstatedict['tab'] == 'explorer_tab':
-
-        sql = "select distinct c_fullname,site,c_name,max(c) c from totalnums_oldcols t inner join bigfullname b on t.fullname_int=b.fullname_int where site!='All' and c_hlevel='%s' and c_fullname like '%s' group by c_fullname,site,c_name" % (
-            appstatedict['hlevel'], '\\'.join(appstatedict['path']) + '\\%')
-        print(sql)
-        dfsub = pd.read_sql_query(sql, conn)
-
-        """traces = []
-        ymax = 0
-        for n in appstatedict['selected']:
-            xf = dfsub[dfsub.c_fullname == n]
-            if len(xf) > 0:
-                fig = px.bar"""
-
-        figure = go.Figure(data=go.Bar(y=[5, 5, 1]))
-        traces=[]
-        x = [
-            ["BB+", "BB+", "BB+", "BB", "BB", "BB"],
-            [16, 17, 18, 16, 17, 18, ]
-        ]
-        fig = go.Figure()
-        fig.add_bar(x=x, y=[1, 2, 3, 4, 5, 6])
-        fig.add_bar(x=x, y=[6, 5, 4, 3, 2, 1])
-        fig.update_layout(barmode="relative")
-
-        return figure
-    return
-    """"# Get just the available data in the df
-    sql = "select distinct c_fullname,site,c_name,max(c) c from totalnums_oldcols t inner join bigfullname b on t.fullname_int=b.fullname_int where site!='All' and c_hlevel='%s' and c_fullname like '%s' group by c_fullname,site,c_name" % (
-     appstatedict['hlevel'], '\\'.join(appstatedict['path']) + '\\%')
-    print(sql)
-    dfsub = pd.read_sql_query(sql, conn)
-
-    traces = []
-    ymax=0
-    for n in appstatedict['selected']:
-        xf = dfsub[dfsub.c_fullname == n]
-        if len(xf) > 0:
-            ymax = max(ymax, xf.groupby(by='c_fullname').max()['c'].values[0])
-            traces.append(
-                #go.Bar(x=xf['site'].tolist(), y=xf['c'].tolist(), text=xf.iloc[0, :].c_name, name=xf.iloc[0, :].c_name))
-                go.Bar(x=xf['site'].tolist(), y=xf['c'].tolist()))
-                          # marker={'size': 15}, mode='lines+markers'))
-    print("Bar time:"+str(time.time()-start))
-
-    #layout =  {'legend':{'x':0,'y':ymax},'showlegend':True}
-    layout = go.Layout(barmode='stack')
-    if len(traces)>0:
-        print(traces)
-    return {'data': traces, 'layout': layout}
-
-    #return {'data': traces}"""
+        dfsub = tabPart(tabData(appstatedict), 'max')
+        # The checked concepts, or the whole level if none of them are on it
+        selected = dfsub[dfsub.c_fullname.isin(appstatedict['selected'])]
+        if len(selected) > 0: dfsub = selected
+        dfsub = dfsub.sort_values(by=['c_fullname', 'site'])
+        # SVG bars get slow with thousands of them, so large levels are drawn as WebGL markers
+        webgl = len(dfsub) > webglpoints
+        traces = []
+        for site, xf in dfsub.groupby('site', sort=True):
+            # Counts under 10 are reported as -1, and non-numeric counts are stored as null
+            hover = ['%s<br>max %s, most recent %s' % (x['c_name'], 'none' if pd.isna(x['c']) else '<10' if x['c'] < 0 else int(x['c']),
+                     'none' if pd.isna(x['recent']) else '<10' if x['recent'] < 0 else int(x['recent'])) for x in xf.to_dict('records')]
+            y = xf['c'].clip(lower=0)
+            if webgl:
+                traces.append(go.Scattergl(x=xf['c_name'], y=y, name=site, hovertext=hover, hoverinfo='text', mode='markers'))
+            else:
+                traces.append(go.Bar(x=xf['c_name'], y=y, name=site, hovertext=hover, hoverinfo='text'))
+        layout = {'barmode':'group','showlegend':True,'yaxis':{'title':'Patients (max among all refreshes)'}}
+        return {'data': traces, 'layout': layout}
+    return dash.no_update
 
 # This callback draws the bar graph whenever checkboxes change
 @app.callback(
     Output('siteoutlier_graph', 'figure'),
     #[Input('items_siteoutlier', 'value')],
-    [Input('app_state', 'children')],
+    [Input('tab_data', 'data')],
     [State('navbuttons', 'children'), State('hlevel_graph', 'figure')]
 )
+@metrics.callback
 def cbSiteoutlierGraph(state,navbuttons,oldfig):
-    global conn
     if (state=='app_state'): return {}
-    start = time.time()
     appstatedict = json.loads(state)
     if (appstatedict['site'] and appstatedict['site']=='All') or appstatedict['tab']!='siteoutlier_tab': return {} # Not support All sites, must choose one for compare
 
-    # Get just the available data in the df
-    sql = "select distinct c_fullname,site,c_name,max(pct) c from totalnums_recent_pct t inner join bigfullname b on t.fullname_int=b.fullname_int where site!='All' and c_hlevel='%s' and c_fullname like '%s' group by c_fullname,site,c_name" % (
-     appstatedict['hlevel'], '\\'.join(appstatedict['path']) + '\\%')
-    dfsub = pd.read_sql_query(sql, conn)
-    print(sql)
-
-    # Also get average
-    sql = "select distinct c_fullname,c_name,average avg, (%s*stdev) stdev from outliers_sites_pct t inner join bigfullname b on t.fullname_int=b.fullname_int where site!='All' and c_hlevel='%s' and c_fullname like '%s' group by c_fullname,site,c_name" % (
-     str(appstatedict['slider']),appstatedict['hlevel'], '\\'.join(appstatedict['path']) + '\\%')
-    dfavg = pd.read_sql_query(sql, conn)
-    print(sql)
+    # Get just the available data in the df, and the average
+    data = tabData(appstatedict)
+    dfsub = tabPart(data, 'pct')
+    dfavg = tabPart(data, 'avg')
 
     traces = []
     n=appstatedict['selected_new']
@@ -621,7 +922,6 @@ def cbSiteoutlierGraph(state,navbuttons,oldfig):
         xf_site = xf[xf['site']==appstatedict['site']]
         xf_notsite=xf[xf['site']!=appstatedict['site']]
         # Site color red or green depending on outlier status
-        print(xf_site['c'].iloc[0])
         site_color= 'rgba(204,50,50,1)' if (abs(xavg['avg']-xf_site['c'].iloc[0])-xavg['stdev']).iloc[0]>0 else 'rgba(50,204,50,1)'
         graph_title = xf_site.iloc[0, :].c_name
         # Site value
@@ -636,8 +936,7 @@ def cbSiteoutlierGraph(state,navbuttons,oldfig):
         #traces.append(
         #     go.Bar(x=[appstatedict['site']], y=xavg['stdev'], text=xf.iloc[0, :].c_name, name=xf.iloc[0, :].c_name))
 
-    print("Bar time:"+str(time.time()-start))
-    layout = go.Layout(barmode='stack', title=graph_title)
+    layout = go.Layout(barmode='stack', title=graph_title, yaxis={'title': 'Percent of %s denominator' % appstatedict['denom']})
     return {'data': traces,'layout':layout}
 
 if __name__=='__main__':
@@ -0,0 +1,74 @@
+import os
+import sqlite3
+import threading
+from urllib.parse import quote
+
+"""
+Per-thread database connections for the dashboard, for SQLite or MSSQL (pyodbc).
+
+Dash callbacks run on whatever thread the server (e.g., gunicorn with --threads) handles the request on, so sharing one
+connection serializes every request on it, and a cursor can be clobbered by another thread mid-query. Here each thread
+gets its own connection, opened the first time it asks. A forked worker (e.g., gunicorn with --preload) never reuses
+its parent's connections.
+
+SQLite connections are read-only. By default they are also opened immutable, so SQLite skips locking and change
+detection, and with a large mmap_size the db pages are read straight from the OS page cache that all workers share.
+An immutable db must not be rebuilt in place while the dashboard is running - restart the dashboard after a rebuild,
+or pass immutable=False.
+"""
+
+""" For SQLite, dbtype = "SQLITE" and db = filename of db
+    For MSSQL, dbtype = "MSSQL" and db is pyodbc format: DSN=MYMSSQL;UID=myuser;PWD=mypassword
+    mmap_size is in bytes, cache_size in KB (SQLite only).
+"""
+class ConnectionManager:
+    def __init__(self, dbtype="SQLITE", db=None, immutable=True, mmap_size=4 * 1024 ** 3, cache_size=65536):
+        self.dbtype = dbtype
+        self.db = db
+        self.immutable = immutable
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.pid = os.getpid()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.opened = 0
+        if dbtype == "MSSQL":
+            import pyodbc
+            pyodbc.pooling = True  # Let the ODBC driver manager reuse connections across threads
+        elif dbtype == "SQLITE" and not os.path.exists(db):
+            raise FileNotFoundError("No totalnum db at " + str(db))
+
+    # Open a new connection (normally use get())
+    def connect(self):
+        if self.dbtype == "SQLITE":
+            uri = 'file:%s?mode=ro%s' % (quote(os.path.abspath(self.db)), '&immutable=1' if self.immutable else '')
+            conn = sqlite3.connect(uri, uri=True, detect_types=sqlite3.PARSE_DECLTYPES)  # Parameter converts datetimes
+            conn.execute("PRAGMA mmap_size=%d" % self.mmap_size)
+            conn.execute("PRAGMA cache_size=-%d" % self.cache_size)
+            conn.execute("PRAGMA temp_store=MEMORY")
+        elif self.dbtype == "MSSQL":
+            import pyodbc
+            conn = pyodbc.connect(self.db)
+        else:
+            raise ValueError("Unknown dbtype " + str(self.dbtype))
+        with self.lock:
+            self.opened += 1
+        return conn
+
+    # This thread's connection
+    def get(self):
+        if os.getpid() != self.pid:
+            # Forked - the parent's connections can't be shared with it
+            self.pid = os.getpid()
+            self.local = threading.local()
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    # Close this thread's connection (others are closed when their threads exit)
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
@@ -0,0 +1,158 @@
+import functools
+import json
+import threading
+import time
+from bisect import bisect_left
+
+import dash
+
+"""
+Instrumentation for the dashboard: latency histograms for the Dash callbacks and the db queries they run, query row
+counts, callback response sizes and result cache lookups, rendered in the Prometheus text format (for a /metrics
+route), and a slow-query log.
+
+Everything is tagged with the callback and tab it happened in. The callback and tab are kept per thread while a
+callback runs (Dash runs each callback request on one server thread), so a query is attributed to the callback that
+ran it without passing anything down. Counters are per process - with several gunicorn workers, each one reports its
+own, which Prometheus tells apart by instance if each worker is scraped, or sums if they're behind one address.
+"""
+
+# Histogram bucket upper bounds
+secondsbuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+rowsbuckets = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 100000, 1000000)
+bytesbuckets = (100, 1000, 10000, 50000, 100000, 500000, 1000000, 5000000, 20000000)
+
+# name: (type, help, buckets)
+definitions = {
+    'totalnum_callback_seconds': ('histogram', 'Dash callback latency', secondsbuckets),
+    'totalnum_callback_errors_total': ('counter', 'Dash callbacks that raised an error', None),
+    'totalnum_callback_response_bytes': ('histogram', 'Size of the Dash callback response', bytesbuckets),
+    'totalnum_query_seconds': ('histogram', 'Database query latency', secondsbuckets),
+    'totalnum_query_rows': ('histogram', 'Rows returned by a database query', rowsbuckets),
+    'totalnum_slow_queries_total': ('counter', 'Database queries slower than the slow query threshold', None),
+    'totalnum_cache_lookups_total': ('counter', 'Result cache lookups, by result (hit or miss)', None),
+}
+
+# Escape a label value for the text format
+def labelValue(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def labelText(labels):
+    return '{' + ','.join('%s="%s"' % (k, labelValue(v)) for k, v in labels) + '}' if labels else ''
+
+# A number in the text format (integers without a decimal point)
+def numberText(v):
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+""" slowms is the slow query threshold in milliseconds. Slow queries are appended to the file slowlog, or printed
+    if it is None.
+"""
+class Metrics:
+    def __init__(self, slowms=500, slowlog=None):
+        self.slowms = slowms
+        self.slowlog = slowlog
+        self.lock = threading.Lock()
+        self.values = {}  # (name, labels) -> count, or [bucket counts..., sum, count] for a histogram
+        self.local = threading.local()
+
+    # The callback and tab this thread is running, as label pairs
+    def context(self):
+        return (('callback', getattr(self.local, 'callback', None) or ''), ('tab', getattr(self.local, 'tab', None) or ''))
+
+    def inc(self, name, n=1, **labels):
+        key = (name, self.context() + tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def observe(self, name, value, **labels):
+        buckets = definitions[name][2]
+        key = (name, self.context() + tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.values.get(key)
+            if h is None:
+                h = self.values[key] = [0] * (len(buckets) + 3)
+            h[bisect_left(buckets, value)] += 1  # The last bucket is +Inf
+            h[-2] += value
+            h[-1] += 1
+
+    """ Decorator for a Dash callback (under @app.callback): times it and tags everything it does with its name and the
+        tab of the app state it was passed (if any). The context is left set after it returns, for response().
+    """
+    def callback(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            self.local.callback = fn.__name__
+            self.local.tab = stateTab(args)
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            except dash.exceptions.PreventUpdate:
+                raise
+            except Exception:
+                self.inc('totalnum_callback_errors_total')
+                raise
+            finally:
+                self.observe('totalnum_callback_seconds', time.time() - start)
+        return wrapper
+
+    # Record the size of the response to the callback this thread just ran
+    def response(self, nbytes):
+        if getattr(self.local, 'callback', None) is None: return
+        self.observe('totalnum_callback_response_bytes', nbytes)
+        self.local.callback = self.local.tab = None
+
+    # Record a query, and log it if it's slow
+    def query(self, sql, seconds, rows):
+        self.observe('totalnum_query_seconds', seconds)
+        self.observe('totalnum_query_rows', rows)
+        if seconds * 1000 >= self.slowms:
+            self.inc('totalnum_slow_queries_total')
+            context = dict(self.context())
+            line = "%s slow query: %.0f ms, %d rows, callback %s, tab %s: %s" % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                    seconds * 1000, rows, context['callback'] or '-', context['tab'] or '-', ' '.join(sql.split()))
+            if self.slowlog:
+                with self.lock, open(self.slowlog, 'a') as f:
+                    f.write(line + '\n')
+            else:
+                print(line)
+
+    # Record a result cache lookup
+    def cacheLookup(self, hit):
+        self.inc('totalnum_cache_lookups_total', result='hit' if hit else 'miss')
+
+    """ All of the metrics in the Prometheus text format. gauges is an optional dict of name: (help, value) to add
+        (e.g., the cache size, which is only known when asked).
+    """
+    def render(self, gauges=None):
+        with self.lock:
+            values = {key: (list(v) if isinstance(v, list) else v) for key, v in self.values.items()}
+        out = []
+        for name, (kind, text, buckets) in definitions.items():
+            out.append('# HELP %s %s' % (name, text))
+            out.append('# TYPE %s %s' % (name, kind))
+            for (n, labels), v in sorted(values.items()):
+                if n != name: continue
+                if kind == 'counter':
+                    out.append('%s%s %s' % (name, labelText(labels), numberText(v)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], v[:-2]):
+                    cumulative += count
+                    out.append('%s_bucket%s %d' % (name, labelText(labels + (('le', bound if bound == '+Inf' else numberText(bound)),)), cumulative))
+                out.append('%s_sum%s %s' % (name, labelText(labels), numberText(v[-2])))
+                out.append('%s_count%s %d' % (name, labelText(labels), v[-1]))
+        for name, (text, value) in (gauges or {}).items():
+            out.append('# HELP %s %s' % (name, text))
+            out.append('# TYPE %s gauge' % name)
+            out.append('%s %s' % (name, numberText(value)))
+        return '\n'.join(out) + '\n'
+
+# The tab of the first JSON app state among a callback's arguments, or ''
+def stateTab(args):
+    for a in args:
+        if isinstance(a, str) and a.startswith('{'):
+            try:
+                return json.loads(a).get('tab') or ''
+            except ValueError:
+                pass
+    return ''
@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+
+"""
+The ontology (bigfullname) as a compact in-memory tree, loaded once when the dashboard starts, so navigation never
+goes to the db. The ontology only changes when the db is rebuilt.
+
+Nodes are rows in pre-order (bigfullname.lo, which is sorted c_fullname order), so a path is found by binary search and
+the nodes under a path prefix are a contiguous range of rows. Per row there is the fullname_int, the parent row, the
+hlevel and the visual attributes (interned), and children are in CSR arrays (child_ptr, child_rows). Paths and names are
+stored as one UTF-8 buffer each with offsets rather than as millions of Python strings, so a multi-million-node ontology
+takes about the size of its text plus ~40 bytes per node.
+"""
+
+# Rows read from the db at a time while loading
+treechunk = 200000
+
+""" Load the tree from an open totalnums db connection (needs bigfullname's hierarchy index from totalnum_builddb_v2) """
+class OntologyTree:
+    def __init__(self, conn):
+        # Each chunk of rows is packed into arrays right away, so the rows are never all held as Python objects
+        ids, parents, hlevels, vas, path_lens, paths, name_lens, names = [], [], [], [], [], [], [], []
+        va_index = {}
+        cur = conn.cursor()
+        # c_hlevel is text in dbs built from ontology files that have it
+        cur.execute("""select fullname_int, parent_int, coalesce(cast(c_hlevel as integer), -1), c_visualattributes, c_fullname, c_name
+            from bigfullname order by lo, fullname_int""")
+        while True:
+            rows = cur.fetchmany(treechunk)
+            if not rows: break
+            n = len(rows)
+            cols = list(zip(*rows))
+            del rows
+            ids.append(np.array(cols[0], dtype='int64'))
+            parents.append(np.array(cols[1], dtype='int64'))
+            hlevels.append(np.array(cols[2], dtype='int16'))
+            vas.append(np.fromiter((va_index.setdefault(v or '', len(va_index)) for v in cols[3]), dtype='int16', count=n))
+            for col, lens, bufs in ((4, path_lens, paths), (5, name_lens, names)):
+                strs = [(v or '').encode('utf-8') for v in cols[col]]
+                lens.append(np.fromiter(map(len, strs), dtype='int64', count=n))
+                bufs.append(b''.join(strs))
+            del cols
+        cur.close()
+        join = lambda arrays, dtype: np.concatenate(arrays) if arrays else np.zeros(0, dtype=dtype)
+        self.ids = join(ids, 'int64')
+        n = len(self.ids)
+        row_of = np.full(int(self.ids.max()) + 1 if n else 0, -1, dtype='int32')
+        row_of[self.ids[::-1]] = np.arange(n - 1, -1, -1, dtype='int32')  # The first row for a duplicated fullname_int
+        self.row_of = row_of
+        parents = join(parents, 'int64')
+        self.parent = np.where(parents >= 0, row_of[np.clip(parents, 0, None)] if n else parents, -1).astype('int32')
+        self.hlevel = join(hlevels, 'int16')
+        self.va_codes = join(vas, 'int16')
+        self.va_values = list(va_index)
+        self.path_off = self.offsets(join(path_lens, 'int64'))
+        self.path_buf = b''.join(paths)
+        self.name_off = self.offsets(join(name_lens, 'int64'))
+        self.name_buf = b''.join(names)
+        del paths, names
+
+        # Children (CSR) - a stable sort keeps each node's children in pre-order
+        haschild = self.parent >= 0
+        kids = np.flatnonzero(haschild).astype('int32')
+        self.child_rows = kids[np.argsort(self.parent[kids], kind='stable')]
+        self.child_ptr = self.offsets(np.bincount(self.parent[kids], minlength=n))
+        self.roots = np.flatnonzero(~haschild).astype('int32')
+        self.minhlevel = int(self.hlevel[self.hlevel >= 0].min()) if (self.hlevel >= 0).any() else 0
+        top = np.flatnonzero(self.hlevel == self.minhlevel)
+        self.start = int(top[0]) if len(top) else 0
+
+    # Offsets (n + 1) from lengths
+    @staticmethod
+    def offsets(lens):
+        off = np.zeros(len(lens) + 1, dtype='int64')
+        np.cumsum(lens, out=off[1:])
+        return off
+
+    def __len__(self):
+        return len(self.ids)
+
+    def pathBytes(self, row):
+        return self.path_buf[self.path_off[row]:self.path_off[row + 1]]
+
+    def fullname(self, row):
+        return self.pathBytes(row).decode('utf-8')
+
+    def name(self, row):
+        return self.name_buf[self.name_off[row]:self.name_off[row + 1]].decode('utf-8')
+
+    def visattr(self, row):
+        return self.va_values[self.va_codes[row]]
+
+    # First row whose path is >= key (bytes)
+    def lowerBound(self, key):
+        a, b = 0, len(self.ids)
+        while a < b:
+            m = (a + b) // 2
+            if self.pathBytes(m) < key: a = m + 1
+            else: b = m
+        return a
+
+    # Row of a c_fullname, or -1
+    def find(self, path):
+        key = path.encode('utf-8')
+        row = self.lowerBound(key)
+        return row if row < len(self.ids) and self.pathBytes(row) == key else -1
+
+    # Range of rows (start, stop) whose path starts with prefix (0xff never occurs in UTF-8)
+    def prefixRange(self, prefix):
+        key = prefix.encode('utf-8')
+        return self.lowerBound(key), self.lowerBound(key + b'\xff')
+
+    def children(self, row):
+        return self.child_rows[self.child_ptr[row]:self.child_ptr[row + 1]]
+
+    """ Rows listed under an app state path (a list of segments, as in cbController): the children of the path's node,
+        or if the path is not a node itself (like the top of the tree), the roots under it.
+    """
+    def childRows(self, path):
+        joined = '\\'.join(path) + '\\'
+        row = self.find(joined)
+        if row >= 0:
+            return self.children(row)
+        start, stop = self.prefixRange(joined)
+        return self.roots[np.searchsorted(self.roots, start):np.searchsorted(self.roots, stop)]
+
+    # fullname_int, c_fullname, c_name, c_visualattributes of rows, as a DataFrame
+    def frame(self, rows):
+        return pd.DataFrame({'fullname_int': self.ids[rows], 'c_fullname': [self.fullname(r) for r in rows],
+                             'c_name': [self.name(r) for r in rows],
+                             'c_visualattributes': [self.va_values[c] for c in self.va_codes[rows]]})
+
+    # The top of the tree for the app state: the first segment of the first path at the minimum hlevel
+    def startPath(self):
+        path = self.fullname(self.start)
+        return path[0:path[1:].find('\\') + 1]
+
+    # The app state path at which a row is listed (its parent's path), as if it had been navigated to from the top
+    def pathTo(self, row):
+        ancestors = []
+        p = self.parent[row]
+        while p >= 0:
+            ancestors.append(p)
+            p = self.parent[p]
+        full = self.fullname(row)
+        path = [full[0:full[1:].find('\\') + 1]]
+        for a in reversed(ancestors):
+            path = self.zoomPath(path, self.fullname(a))
+        return path
+
+    """ The app state path after zooming into the child with c_fullname selected. Only one segment is added, for reverse
+        navigation, but it takes in any untraversed segments (like ACT's version segments) that are not nodes themselves.
+    """
+    @staticmethod
+    def zoomPath(path, selected):
+        joined = '\\'.join(path)
+        return path + [selected[selected.find(joined) + len(joined) + 1:-1]]
@@ -0,0 +1,180 @@
+import argparse
+import html
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import totalnum_dbconn
+
+"""
+Static per-site reports from a totalnums db built by totalnum_builddb_v2, for network admins after each collection
+round. Every site gets report_[site].html with:
+  Summary - the site's most recent counts for the summary concepts (toplevel_fullnames), against the network median
+  Missingness - non-leaf concepts missing at the site but present at another site (from missing_bits)
+  Variability - concepts whose percent of the denominator is furthest from the network average (outliers_sites_pct)
+  Refresh deltas - the biggest drops at the last refresh, and concepts outside their control limits (totalnums_trend)
+plus an index.html linking them. Sites are rendered in parallel worker processes, which all open the one db read-only
+(and immutable, with mmap), so they share its pages in the OS cache rather than each reading a copy.
+
+Usage: python totalnum_report.py --db /path/to/totalnums.db --outdir reports_html --jobs 8
+"""
+
+# Rows listed per section
+listlimit = 100
+
+# SQL for each section, for a site. The dashboard uses these too.
+
+def summarySql(site):
+    return """select b.domain, b.c_name, r.agg_count count,
+        (select median from outliers_sites o where o.fullname_int=f.fullname_int limit 1) network_median,
+        (select num_sites from outliers_sites o where o.fullname_int=f.fullname_int limit 1) sites_reporting
+        from toplevel_fullnames f inner join bigfullname b on b.fullname_int=f.fullname_int
+        left join totalnums_recent r on r.fullname_int=f.fullname_int and r.site='%s'
+        order by b.domain, b.c_name""" % site
+
+# Percent of the denominator furthest from the network average, in stdevs (z), beyond threshold stdevs
+def outlierSql(site, denom, threshold=2, limit=listlimit):
+    return """select b.c_name, b.c_fullname, o.pct, o.average, o.stdev, (o.pct-o.average)/o.stdev z, o.num_sites
+        from outliers_sites_pct o inner join bigfullname b on b.fullname_int=o.fullname_int
+        where o.site='%s' and o.denom='%s' and o.stdev>0 and abs(o.pct-o.average)>%s*o.stdev
+        order by abs(o.pct-o.average)/o.stdev desc limit %d""" % (site, denom, float(threshold), limit)
+
+def dropsSql(site, limit=listlimit):
+    return """select b.c_name, b.c_fullname, t.prev_count, t.last_count, t.delta, t.pct_change, t.last_date, t.breach
+        from totalnums_trend t inner join bigfullname b on b.fullname_int=t.fullname_int
+        where t.site='%s' and t.delta<0 order by t.delta limit %d""" % (site, limit)
+
+def breachSql(site, limit=listlimit):
+    return """select b.c_name, b.c_fullname, t.last_count, t.mean, t.lcl, t.ucl, t.n refreshes, t.last_date
+        from totalnums_trend t inner join bigfullname b on b.fullname_int=t.fullname_int
+        where t.site='%s' and t.breach=1 order by abs(t.last_count-t.mean) desc limit %d""" % (site, limit)
+
+# Set in each worker by workerInit
+dbconns = None
+options = None
+present = None
+missingNames = None
+siteBits = None
+
+""" Open the db (read-only) in a worker, and load what every site's report shares: the presence bitsets and the names
+    of the non-leaf, non-hidden concepts that the missingness section lists.
+"""
+def workerInit(db, opts):
+    global dbconns, options, present, missingNames, siteBits
+    options = opts
+    dbconns = totalnum_dbconn.ConnectionManager("SQLITE", db)
+    conn = dbconns.get()
+    siteBits = {s: i for i, (s,) in enumerate(conn.execute("select site from sites order by site_int"))}
+    nbytes = (len(siteBits) + 7) // 8
+    rows = conn.execute("select fullname_int, present from missing_bits").fetchall()
+    ids = np.array([r[0] for r in rows], dtype='int64')
+    bits = np.frombuffer(b''.join(r[1] for r in rows), dtype='uint8').reshape(-1, nbytes) if rows else np.zeros((0, nbytes), dtype='uint8')
+    present = (ids, bits)
+    missingNames = pd.read_sql_query("""select fullname_int, c_fullname, c_name from bigfullname
+        where c_visualattributes not like 'L%' and c_visualattributes not like '_H%'""", conn).drop_duplicates('fullname_int').set_index('fullname_int')
+
+# Non-leaf concepts missing at site but present at another site, in path order
+def missing(site):
+    ids, bits = present
+    if site not in siteBits or len(ids) == 0: return pd.DataFrame(columns=['c_name', 'c_fullname'])
+    b = siteBits[site]
+    here = (bits[:, b // 8] >> (b % 8)) & 1 == 1
+    gone = ids[bits.any(axis=1) & ~here]
+    return missingNames.loc[missingNames.index.intersection(gone), ['c_name', 'c_fullname']].sort_values('c_fullname')
+
+# Whole numbers (like counts that are floats because some are null) without decimals
+def numberText(x):
+    return '%d' % x if float(x).is_integer() else '%.2f' % x
+
+# A section of the report: a heading, a line about it, and the first rows of df as a table
+def section(title, note, df, limit=listlimit):
+    more = '' if len(df) <= limit else '<p>(First %d of %d.)</p>' % (limit, len(df))
+    table = df.head(limit).to_html(index=False, na_rep='', float_format=numberText, classes='t', border=0) if len(df) > 0 else '<p>None.</p>'
+    return '<h2>%s</h2>\n<p>%s</p>\n%s\n%s\n' % (html.escape(title), html.escape(note), table, more)
+
+# File name of a site's report
+def reportName(site):
+    return 'report_%s.html' % re.sub(r'[^A-Za-z0-9_.-]', '_', site)
+
+style = """<style>body{font-family:sans-serif;margin:2em} table.t{border-collapse:collapse;font-size:10pt}
+table.t td,table.t th{border:1px solid #ccc;padding:2px 6px;text-align:left} h2{margin-top:1.5em}</style>"""
+
+""" Render one site's report into options['outdir'] (in a worker). Returns the site, its section row counts, and the
+    time it took.
+"""
+def siteReport(site):
+    start = time.time()
+    conn = dbconns.get()
+    read = lambda sql: pd.read_sql_query(sql, conn)
+    info = read("""select count(distinct agg_date) refreshes, date(max(agg_date)*86400, 'unixepoch') last_refresh, count(distinct fullname_int) concepts
+        from totalnums_int where site_int=(select site_int from sites where site='%s')""" % site).iloc[0]
+    summary = read(summarySql(site))
+    miss = missing(site)
+    outliers = read(outlierSql(site, options['denom'], options['threshold']))
+    drops = read(dropsSql(site))
+    breaches = read(breachSql(site))
+    page = ['<html><head><meta charset="utf-8"><title>%s totalnum report</title>%s</head><body>' % (html.escape(site), style),
+            '<h1>%s totalnum report</h1>' % html.escape(site),
+            '<p>%d refreshes, the last on %s, with %d concepts. Generated %s.</p>' % (info['refreshes'], info['last_refresh'],
+                info['concepts'], options['generated']),
+            section('Summary', 'Most recent counts of the summary concepts, with the median across sites.', summary, len(summary)),
+            section('Missingness', 'Non-leaf concepts with no patients at this site, but patients at another site.', miss),
+            section('Variability', "Concepts whose percent of the %s denominator is more than %s stdevs from the network average (z)."
+                    % (options['denom'], options['threshold']), outliers),
+            section('Biggest drops since the last refresh', 'Change in count between the last two refreshes (breach: outside the control limits).', drops),
+            section('Outside control limits', 'The last count is outside the mean +/- 3 stdevs of the earlier refreshes.', breaches),
+            '</body></html>']
+    with open(os.path.join(options['outdir'], reportName(site)), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(page))
+    return site, {'missing': len(miss), 'outliers': len(outliers), 'drops': len(drops), 'breaches': len(breaches)}, time.time() - start
+
+""" Render every site's report (or just sites) with jobs worker processes, and an index of them. Prints progress as
+    sites finish. denom defaults to the db's default denominator.
+"""
+def writeReports(db, outdir, jobs=None, sites=None, denom=None, threshold=1.5):
+    start = time.time()
+    os.makedirs(outdir, exist_ok=True)
+    conn = totalnum_dbconn.ConnectionManager("SQLITE", db).get()
+    allsites = [r[0] for r in conn.execute("select site from sites order by site")]
+    sites = [s for s in allsites if s in sites] if sites else allsites
+    if denom is None:
+        # dbs built without denominators (or before they were stored) have no default
+        row = conn.execute("select denom from denominators order by ord limit 1").fetchone() \
+            if conn.execute("select 1 from sqlite_master where type='table' and name='denominators'").fetchone() else None
+        if row is None:
+            conn.close()
+            raise ValueError("No denominators in %s, so give one with --denominator (or rebuild it with totalnum_builddb_v2)" % db)
+        denom = row[0]
+    conn.close()
+    opts = {'outdir': outdir, 'denom': denom, 'threshold': threshold, 'generated': time.strftime('%Y-%m-%d %H:%M')}
+    jobs = min(jobs or os.cpu_count() or 1, max(len(sites), 1))
+    print("Writing %d site reports to %s with %d workers..." % (len(sites), outdir, jobs))
+    results = []
+    with ProcessPoolExecutor(jobs, initializer=workerInit, initargs=(db, opts)) as pool:
+        for n, future in enumerate(as_completed([pool.submit(siteReport, s) for s in sites]), start=1):
+            site, counts, secs = future.result()
+            results.append((site, counts))
+            print("  %d/%d %s (%.1f sec, %.1f sec elapsed)" % (n, len(sites), site, secs, time.time() - start))
+    index = pd.DataFrame([dict(site='<a href="%s">%s</a>' % (reportName(s), html.escape(s)), **c) for s, c in sorted(results)])
+    with open(os.path.join(outdir, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write('<html><head><meta charset="utf-8"><title>Totalnum reports</title>%s</head><body><h1>Totalnum reports</h1>' % style)
+        f.write('<p>Generated %s. Variability uses the %s denominator. Counts are of the rows listed, at most %d.</p>' % (opts['generated'], denom, listlimit))
+        f.write(index.to_html(index=False, escape=False, classes='t', border=0) if len(index) > 0 else '<p>No sites.</p>')
+        f.write('</body></html>')
+    print("Wrote %d reports in %.1f sec" % (len(results), time.time() - start))
+    return results
+
+if __name__=='__main__':
+    parser = argparse.ArgumentParser(description="Write a static HTML report for every site in a totalnums db")
+    parser.add_argument('--db', required=True, help="The totalnums.db built by totalnum_builddb_v2")
+    parser.add_argument('--outdir', default='totalnum_reports', help="Where to write the reports")
+    parser.add_argument('--jobs', type=int, default=None, help="Number of worker processes (default: one per CPU)")
+    parser.add_argument('--site', action='append', help="Only report this site (repeat for more)")
+    parser.add_argument('--denominator', default=None, help="Denominator for the variability section (default: the db's default)")
+    parser.add_argument('--threshold', type=float, default=1.5, help="Variability outliers are more than this many stdevs from the average")
+    args = parser.parse_args()
+    writeReports(args.db, args.outdir, args.jobs, args.site, args.denominator, args.threshold)